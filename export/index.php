@@ -57,6 +57,9 @@ elseif (!strcmp("pdf", $format)) {
 elseif (!strcmp("svg", $format)) {
     $export = new MapnikSVGExport($pois, $areas, $qrcode);
 }
+elseif (!strcmp("png", $format)) {
+    $export = new MapnikPNGExport($pois, $areas, $qrcode);
+}
 
 // download output as file
 if ($export) {
@@ -203,7 +206,7 @@ class KMZExport extends ExportBase {
 }
 
 class MapnikExport extends ExportBase {
-    protected $mapnik, $output_file;
+    protected $mapnik, $content;
 
     function export() {
         global $cfg;
@@ -243,12 +246,12 @@ class MapnikExport extends ExportBase {
                 unlink($this->qrcode);
 
             if ($return_value == 0) {
-                $output = trim($output);
-                if (file_exists($output)) {
-                  $this->output_file = $output;
+                // renderer writes the export to stdout
+                if (strlen($output) > 0) {
+                  $this->content = $output;
                   return true;
                 }
-                $this->error .= " ERROR: file '" . $output . "' does not exist!";
+                $this->error .= " ERROR: renderer gave no output!";
             }
             $this->error = $output . "\n" . $this->error;
             $this->error = "(" . $return_value . ") " . $this->error;
@@ -263,10 +266,14 @@ class MapnikExport extends ExportBase {
         $cmd = $cfg['mapnik_bin'];
         $bounds = $_POST['bbox'];
         $cmd .= ' --bbox "' . $bounds . '"';
+        $cmd .= ' --output -';
 
         if (isset($_POST['format']))
             $cmd .= ' --outputformat ' . $_POST['format'];
 
+        if (isset($_POST['format']) && !strcmp("png", $_POST['format']) && isset($cfg['png_dpi']))
+            $cmd .= ' --dpi ' . intval($cfg['png_dpi']);
+
         if (isset($_POST['map-source']))
             $cmd .= ' --tiles ' . $_POST['map-source'];
 
@@ -280,7 +287,7 @@ class MapnikExport extends ExportBase {
     }
 
     function getContent() {
-        return file_get_contents($this->output_file);
+        return $this->content;
     }
 
 }
@@ -309,4 +316,16 @@ class MapnikSVGExport extends MapnikExport {
     }
 }
 
+class MapnikPNGExport extends MapnikExport {
+
+    function getFiletype() {
+        return "image/png";
+    }
+
+    // Returns filename in format 'map_<number>_2010-10-28_180623.png
+    function genFilename() {
+        return $this->genFilenameWithExt("png");
+    }
+}
+
 ?>
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Benchmark for tile downloader against a local stand-in tile server.
+# Downloads the same set of tiles for several renders and prints time
+# taken and how many connections the server had to accept.
+# "fresh" starts a new downloader for every render with one connection per
+# host, like tile loaders used to do, "shared" reuses one downloader.
+# Example:
+# ./bench_downloader.py -n 64 -r 5 --delay 0.02
+import sys
+import time
+import argparse
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+from downloader import Downloader, DEFAULT_CONCURRENCY
+
+# smallest valid PNG, 1x1 transparent pixel
+PNG = ('\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+       '\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f'
+       '\x00\x01\x01\x01\x00\x18\xdd\x8d\xb0\x00\x00\x00\x00IEND\xaeB`\x82')
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive like real tile servers
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        data = PNG * (self.server.tile_size // len(PNG) + 1)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay, tile_size):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TileHandler)
+        self.delay = delay
+        self.tile_size = tile_size
+        # shared with benchmark process
+        self.connections = multiprocessing.Value('i', 0)
+
+    def process_request(self, request, client_address):
+        with self.connections.get_lock():
+            self.connections.value += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+def run(name, server, make_downloader, tiles, renders):
+    server.connections.value = 0
+    downloader = None
+    start = time.time()
+    for i in range(renders):
+        if downloader is None or name == 'fresh':
+            downloader = make_downloader()
+        batch = downloader.batch()
+        for t in range(tiles):
+            batch.download(t, 'http://127.0.0.1:%d/1/%d/%d.png' % (server.server_port, i, t))
+        batch.wait()
+        if len(batch.results) != tiles:
+            raise SystemExit("%s: %d tiles were not downloaded" % (name, tiles - len(batch.results)))
+    elapsed = time.time() - start
+    sys.stdout.write("%-8s %5d tiles  %8.3f s  %8.1f tiles/s  %5d connections\n" % (
+        name, tiles * renders, elapsed, tiles * renders / elapsed, server.connections.value))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Tile downloader benchmark.')
+    parser.add_argument('-n', '--tiles', required=False, type=int, default=64,
+                        help='tiles per render')
+    parser.add_argument('-r', '--renders', required=False, type=int, default=5)
+    parser.add_argument('-c', '--concurrency', required=False, type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--delay', required=False, type=float, default=0.02,
+                        help='server response time in seconds')
+    parser.add_argument('--tile-size', required=False, type=int, default=20000,
+                        help='bytes per tile')
+    args = parser.parse_args()
+
+    # server runs in its own process, like a real tile server
+    server = TileServer(args.delay, args.tile_size)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.start()
+
+    try:
+        run('fresh', server, lambda: Downloader(5, pool_size=1),
+            args.tiles, args.renders)
+        run('shared', server, lambda: Downloader(args.concurrency),
+            args.tiles, args.renders)
+    finally:
+        process.terminate()
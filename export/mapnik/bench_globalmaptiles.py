@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Micro-benchmark for GlobalMercator array methods.
+# Checks that array methods give the same results as scalar methods
+# and prints time taken by both.
+# Example:
+# ./bench_globalmaptiles.py -n 100000
+import sys
+import time
+import random
+import argparse
+from globalmaptiles import GlobalMercator
+
+def timed(name, n, scalar, array):
+    """Runs scalar and array versions, prints times and returns results."""
+    start = time.time()
+    scalar_result = scalar()
+    scalar_time = time.time() - start
+    start = time.time()
+    array_result = array()
+    array_time = time.time() - start
+    sys.stdout.write("%-20s %8d  scalar %8.4f s  array %8.4f s  %6.1fx\n" % (
+        name, n, scalar_time, array_time, scalar_time / max(array_time, 1e-9)))
+    return scalar_result, array_result
+
+def check(name, scalar_result, array_result):
+    if list(scalar_result) != list(array_result):
+        raise SystemExit("%s: array results differ from scalar results" % name)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='GlobalMercator benchmark.')
+    parser.add_argument('-n', '--count', required=False, type=int, default=100000)
+    parser.add_argument('-z', '--zoom', required=False, type=int, default=16)
+    args = parser.parse_args()
+
+    n = args.count
+    zoom = args.zoom
+    mercator = GlobalMercator()
+    random.seed(0)
+    lats = [random.uniform(-85, 85) for i in range(n)]
+    lons = [random.uniform(-180, 180) for i in range(n)]
+
+    s, a = timed('LatLonToMeters', n,
+                 lambda: [mercator.LatLonToMeters(lat, lon) for lat, lon in zip(lats, lons)],
+                 lambda: mercator.LatLonToMetersArray(lats, lons))
+    check('LatLonToMeters', s, zip(a[0].tolist(), a[1].tolist()))
+    mxs = a[0].tolist()
+    mys = a[1].tolist()
+
+    s, a = timed('MetersToLatLon', n,
+                 lambda: [mercator.MetersToLatLon(mx, my) for mx, my in zip(mxs, mys)],
+                 lambda: mercator.MetersToLatLonArray(mxs, mys))
+    check('MetersToLatLon', s, zip(a[0].tolist(), a[1].tolist()))
+
+    s, a = timed('MetersToPixels', n,
+                 lambda: [mercator.MetersToPixels(mx, my, zoom) for mx, my in zip(mxs, mys)],
+                 lambda: mercator.MetersToPixelsArray(mxs, mys, zoom))
+    check('MetersToPixels', s, zip(a[0].tolist(), a[1].tolist()))
+
+    s, a = timed('MetersToTile', n,
+                 lambda: [mercator.MetersToTile(mx, my, zoom) for mx, my in zip(mxs, mys)],
+                 lambda: mercator.MetersToTileArray(mxs, mys, zoom))
+    check('MetersToTile', s, zip(a[0].tolist(), a[1].tolist()))
+    txs = a[0].tolist()
+    tys = a[1].tolist()
+
+    s, a = timed('TileBounds', n,
+                 lambda: [mercator.TileBounds(tx, ty, zoom) for tx, ty in zip(txs, tys)],
+                 lambda: mercator.TileBoundsArray(txs, tys, zoom))
+    check('TileBounds', s, zip(*[v.tolist() for v in a]))
+
+    s, a = timed('TileLatLonBounds', n,
+                 lambda: [mercator.TileLatLonBounds(tx, ty, zoom) for tx, ty in zip(txs, tys)],
+                 lambda: mercator.TileLatLonBoundsArray(txs, tys, zoom))
+    check('TileLatLonBounds', s, zip(*[v.tolist() for v in a]))
+
+    s, a = timed('GoogleTile', n,
+                 lambda: [mercator.GoogleTile(tx, ty, zoom) for tx, ty in zip(txs, tys)],
+                 lambda: mercator.GoogleTileArray(txs, tys, zoom))
+    check('GoogleTile', s, zip(a[0].tolist(), a[1].tolist()))
+
+    s, a = timed('QuadTree', n,
+                 lambda: [mercator.QuadTree(tx, ty, zoom) for tx, ty in zip(txs, tys)],
+                 lambda: mercator.QuadTreeArray(txs, tys, zoom))
+    check('QuadTree', s, a)
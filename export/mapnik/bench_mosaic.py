@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Benchmark for painting raster tiles to PDF one by one versus as one
+# cropped mosaic. Synthetic tiles are drawn with cairo, the map is placed
+# so that edge tiles are partly outside it like in real exports. Prints
+# best time of --repeat runs and size of the PDF file for both, and their
+# ratio to painting tiles one by one.
+# Example:
+# ./bench_mosaic.py -W 1484 -H 990 --dpi 300
+from __future__ import division
+import os
+import io
+import sys
+import time
+import math
+import random
+import tempfile
+import argparse
+import cairo
+from mosaic import Mosaic, TILE_SIZE
+
+def make_tile(seed):
+    """Returns PNG data of a tile with some lines and noise."""
+    rnd = random.Random(seed)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, TILE_SIZE, TILE_SIZE)
+    ctx = cairo.Context(surface)
+    ctx.set_source_rgb(0.95, 0.93, 0.9)
+    ctx.paint()
+    for i in range(200):
+        ctx.set_source_rgb(rnd.random(), rnd.random(), rnd.random())
+        ctx.move_to(rnd.uniform(0, TILE_SIZE), rnd.uniform(0, TILE_SIZE))
+        ctx.line_to(rnd.uniform(0, TILE_SIZE), rnd.uniform(0, TILE_SIZE))
+        ctx.set_line_width(rnd.uniform(0.5, 4))
+        ctx.stroke()
+    f = io.BytesIO()
+    surface.write_to_png(f)
+    return f.getvalue()
+
+def render(name, width, height, offset, tiles, draw, repeat, baseline=None):
+    """Renders map to PDF with draw(ctx) repeat times, prints best time
+       and size, relative to baseline (time, size) if given. Returns
+       (time, size)."""
+    best = None
+    for i in range(repeat):
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        start = time.time()
+        surface = cairo.PDFSurface(filename, width, height)
+        ctx = cairo.Context(surface)
+        ctx.rectangle(0, 0, width, height)
+        ctx.clip()
+        draw(ctx)
+        surface.finish()
+        elapsed = time.time() - start
+        size = os.path.getsize(filename)
+        os.unlink(filename)
+        best = elapsed if best is None else min(best, elapsed)
+    sys.stdout.write("%-8s %4d tiles  %8.3f s  %10d bytes" % (name, len(tiles), best, size))
+    if baseline is not None:
+        sys.stdout.write("  time %5.2fx  size %5.2fx" % (best / baseline[0], size / baseline[1]))
+    sys.stdout.write("\n")
+    return (best, size)
+
+def draw_tiles(ctx, tiles, offset):
+    """Paints every tile separately, like tile layers used to do."""
+    for (tx, ty, data) in tiles:
+        img = cairo.ImageSurface.create_from_png(io.BytesIO(data))
+        ctx.set_source_surface(img, tx * TILE_SIZE - offset, ty * TILE_SIZE - offset)
+        ctx.paint()
+
+def draw_mosaic(ctx, tiles, offset, width, height, factor):
+    """Paints tiles as one mosaic cropped to the map."""
+    rows = max(ty for (tx, ty, data) in tiles)
+    mosaic = Mosaic(0, rows, offset, offset, width, height)
+    for (tx, ty, data) in tiles:
+        # mosaic uses TMS rows
+        mosaic.add(tx, rows - ty, data)
+    surface = mosaic.surface
+    if factor < 1:
+        surface = mosaic.resample(int(round(width * factor)), int(round(height * factor)))
+    ctx.scale(width / surface.get_width(), height / surface.get_height())
+    ctx.set_source_surface(surface, 0, 0)
+    ctx.paint()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Tile mosaic benchmark.')
+    parser.add_argument('-W', '--width', required=False, type=int, default=1484,
+                        help='map width in tile pixels')
+    parser.add_argument('-H', '--height', required=False, type=int, default=990,
+                        help='map height in tile pixels')
+    parser.add_argument('--dpi', required=False, type=float, default=0,
+                        help='also resample mosaic to this resolution, tile pixel is one point')
+    parser.add_argument('-n', '--repeat', required=False, type=int, default=3,
+                        help='render each map this many times, best time is shown')
+    args = parser.parse_args()
+
+    # map starts from the middle of the first tile
+    offset = TILE_SIZE // 2
+    cols = int(math.ceil((args.width + offset) / float(TILE_SIZE)))
+    rows = int(math.ceil((args.height + offset) / float(TILE_SIZE)))
+    tiles = [(tx, ty, make_tile(ty * cols + tx)) for ty in range(rows) for tx in range(cols)]
+
+    baseline = render('tiles', args.width, args.height, offset, tiles,
+                      lambda ctx: draw_tiles(ctx, tiles, offset), args.repeat)
+    render('mosaic', args.width, args.height, offset, tiles,
+           lambda ctx: draw_mosaic(ctx, tiles, offset, args.width, args.height, 1),
+           args.repeat, baseline)
+    if args.dpi:
+        render('%gdpi' % args.dpi, args.width, args.height, offset, tiles,
+               lambda ctx: draw_mosaic(ctx, tiles, offset, args.width, args.height,
+                                       args.dpi / 72), args.repeat, baseline)
@@ -15,51 +15,433 @@ GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License
 along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Tile download engine shared by all tile loaders of a process.
+
+Downloads are done by a fixed number of long-lived threads using one
+urllib3 PoolManager whose per-host pools are as large as the number of
+threads, so connections are kept alive and reused across tiles, loaders
+and renders. Downloaded data is kept in memory, callers group their
+downloads in a DownloadBatch, wait only for their own downloads and get
+the results from the batch.
+
+Failed downloads are retried with exponential backoff and jitter, and
+Retry-After of throttling responses is honoured. Simultaneous downloads
+from one host are limited by HostLimiter, which halves the limit when the
+host throttles or times out and raises it slowly while responses are fast.
+Limits are given per tile source with FetchPolicy.
+
+A tile may be downloaded from several mirrors of the tile source, see
+mirrors.py. Retries go to another mirror, and when a download takes longer
+than most recent ones, HedgeMonitor sends the same request to the fastest
+other mirror. The first successful response is the result.
 """
 
+from __future__ import division
+import os
 import sys
+import time
+import heapq
+import random
+import urlparse
 import Queue
 import threading
+import itertools
 import urllib3
 import traceback
+import email.utils
+import stats
+from mirrors import MirrorSet
+
+# simultaneous downloads, also maximum connections per host
+DEFAULT_CONCURRENCY = 8
+# seconds
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# statuses worth retrying, throttling ones also lower host concurrency
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+
+# retries are done by DownloadThread, not urllib3
+NO_RETRIES = urllib3.Retry(total=None, connect=0, read=0, status=0, redirect=5)
+
+class FetchPolicy(object):
+    """Retry and concurrency limits of a tile source, given as "fetch"
+       object in tiles.json. Durations are in seconds."""
+    DEFAULTS = {
+        'retries': 4,           # attempts after the first one
+        'backoff': 0.5,         # delay before first retry, doubled every time
+        'max_backoff': 30,      # longest delay, also for Retry-After
+        'min_concurrency': 1,
+        'max_concurrency': None, # downloader concurrency
+        'latency': 2.0,         # concurrency is raised only below this
+        'hedge_percentile': 95, # slower downloads are hedged, None for never
+    }
+
+    def __init__(self, options=None):
+        for key, value in self.DEFAULTS.iteritems():
+            setattr(self, key, value)
+        for key, value in (options or {}).iteritems():
+            if key not in self.DEFAULTS:
+                raise ValueError("Unknown fetch option: %s" % key)
+            setattr(self, key, value)
+
+    def delay(self, attempt, retry_after=None):
+        """Returns seconds to wait before retrying after given attempt."""
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        # full jitter keeps threads from retrying in lockstep
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+class HostLimiter(object):
+    """Limits simultaneous downloads from one host. The limit is halved
+       when host throttles and raised by one per limit successful fast
+       downloads (additive increase, multiplicative decrease)."""
+    def __init__(self, min_limit, max_limit):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def set_bounds(self, min_limit, max_limit):
+        with self.condition:
+            self.min_limit = min_limit
+            self.max_limit = max_limit
+            self.limit = min(max(self.limit, min_limit), max_limit)
+            self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= max(int(self.limit), 1):
+                self.condition.wait(1)
+            self.active += 1
+
+    def release(self, throttled, latency, target_latency):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(self.limit / 2, self.min_limit)
+            elif latency <= target_latency:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.condition.notify_all()
+
+def parse_retry_after(value):
+    """Returns seconds from Retry-After header value, which is either
+       seconds or HTTP date, or None."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+class Download(object):
+    """Download of one tile from its mirrors. A hedged request may run at
+       the same time, the first successful response is the result."""
+    def __init__(self, batch, key, urls, headers, policy, mirrors):
+        self.batch = batch
+        self.key = key
+        # url of the tile on every mirror
+        self.urls = urls
+        self.headers = headers
+        self.policy = policy
+        self.mirrors = mirrors
+        # mirror and error of the latest attempt
+        self.mirror = None
+        self.error = None
+        self.active = 1
+        self.hedged = False
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start_hedge(self):
+        """Returns True if a hedged request may be started."""
+        with self.lock:
+            if self.finished or self.hedged:
+                return False
+            self.hedged = True
+            self.active += 1
+            return True
+
+    def end(self, result):
+        """Ends one request, the download is done when a request succeeds
+           or the last one fails."""
+        with self.lock:
+            self.active -= 1
+            if self.finished or (result is None and self.active > 0):
+                return
+            self.finished = True
+        if result is None:
+            sys.stderr.write("%s could not be downloaded: %s\n" % (self.urls[self.mirror or 0],
+                                                                   self.error))
+        try:
+            self.batch.done(self.key, result)
+        except Exception as e:
+            # error in callback, keep thread running
+            sys.stderr.write(traceback.format_exc())
 
 class DownloadThread(threading.Thread):
-    def __init__(self, manager, queue):
+    def __init__(self, downloader, queue):
         threading.Thread.__init__(self)
-        self.manager = manager
+        self.downloader = downloader
         self.queue = queue
 
     def run(self):
         while True:
-            # get url and headers from queue
-            data = self.queue.get()
-            # write output to a file
+            download = self.queue.get()
+            if download is None:
+                # downloader closed
+                self.queue.task_done()
+                break
+            result = None
             try:
-                r = self.manager.request(method='GET', url=data['url'], headers=data['headers'])
-                f = open(data['output'], 'w')
-                f.write(r.data)
-                f.close()
-            except IOError as e:
-                sys.stderr.write('Could not save file: ' + str(e) + "\n")
+                result = self.downloader.fetch(download)
             except Exception as e:
                 sys.stderr.write(traceback.format_exc())
+            download.end(result)
             self.queue.task_done()
 
+class HedgeMonitor(threading.Thread):
+    """Sends a hedged request to another mirror when a download is not
+       done within the hedge delay of its mirrors."""
+    def __init__(self, downloader, max_hedges):
+        threading.Thread.__init__(self)
+        self.downloader = downloader
+        self.slots = threading.BoundedSemaphore(max_hedges)
+        # (deadline, sequence, download)
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def watch(self, download, delay):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.sequence), download))
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    while self.heap and self.heap[0][2].finished:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                    elif self.heap[0][0] > time.time():
+                        self.condition.wait(self.heap[0][0] - time.time())
+                    else:
+                        break
+                download = heapq.heappop(self.heap)[2]
+            # hedges in flight are limited, others are skipped
+            if not self.slots.acquire(False):
+                continue
+            if not download.start_hedge():
+                self.slots.release()
+                continue
+            t = threading.Thread(target=self._hedge, args=(download,))
+            t.setDaemon(True)
+            t.start()
+
+    def _hedge(self, download):
+        result = None
+        stats.count('tile_hedges')
+        try:
+            i = download.mirrors.choose((download.mirror,), fastest=True)
+            result = self.downloader.request(download, i)[0]
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc())
+        finally:
+            self.slots.release()
+        download.end(result)
+
+class DownloadBatch(object):
+    """Downloads of one caller, waited independently of other downloads
+       running in the same downloader. callback(key, result) is called
+       from download thread when a download is done, result is None if
+       it failed."""
+    def __init__(self, downloader, callback=None):
+        self.downloader = downloader
+        self.callback = callback
+        self.pending = 0
+        # (content type, data) of successful downloads by key
+        self.results = {}
+        self.condition = threading.Condition()
+
+    def download(self, key, url, headers=None, policy=None, mirrors=None):
+        """Queues download of url, result is saved by key. url may be a
+           list of urls, one for every mirror of MirrorSet mirrors."""
+        if policy is None:
+            policy = FetchPolicy()
+        urls = [url] if isinstance(url, basestring) else url
+        if mirrors is None:
+            mirrors = MirrorSet(urls)
+        with self.condition:
+            self.pending += 1
+        self.downloader.queue.put(Download(self, key, urls, headers, policy, mirrors))
+
+    def done(self, key, result):
+        try:
+            if self.callback is not None:
+                self.callback(key, result)
+        finally:
+            with self.condition:
+                if result is not None:
+                    self.results[key] = result
+                self.pending -= 1
+                if self.pending == 0:
+                    self.condition.notify_all()
+
+    def wait(self):
+        """Waits until every download of the batch has been processed"""
+        with self.condition:
+            while self.pending > 0:
+                # timeout keeps the wait interruptible
+                self.condition.wait(1)
+
 class Downloader(object):
-    def __init__(self, threads=5):
-        manager = urllib3.PoolManager()
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, pool_size=None):
+        self.concurrency = concurrency
+        self.pid = os.getpid()
+        # one pool per host, as many connections as there are threads
+        if pool_size is None:
+            pool_size = concurrency
+        manager = urllib3.PoolManager(
+                maxsize=pool_size, block=pool_size >= concurrency,
+                timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT))
+        self.manager = manager
         self.queue = Queue.Queue()
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
         # spawn pool of threads
-        for i in range(threads):
-            t = DownloadThread(manager, self.queue)
+        for i in range(concurrency):
+            t = DownloadThread(self, self.queue)
             t.setDaemon(True)
             t.start()
+        self.hedger = HedgeMonitor(self, max(concurrency // 4, 1))
+        self.hedger.setDaemon(True)
+        self.hedger.start()
 
-    def download(self, output, url, headers=None):
-         self.queue.put({ 'output':  output,
-                          'url':     url,
-                          'headers': headers })
+    def fetch(self, download):
+        """Downloads tile from its mirrors, retrying failures allowed by
+           policy on other mirrors. Returns (content type, data) or None."""
+        policy = download.policy
+        failed = set()
+        for attempt in range(policy.retries + 1):
+            if download.finished:
+                # hedged request won
+                return None
+            i = download.mirrors.choose(failed)
+            download.mirror = i
+            if attempt == 0 and policy.hedge_percentile is not None:
+                delay = download.mirrors.hedge_delay(policy.hedge_percentile)
+                if delay is not None:
+                    self.hedger.watch(download, delay)
+            result, error, retryable, retry_after = self.request(download, i)
+            if result is not None:
+                return result
+            if not retryable:
+                break
+            failed.add(i)
+            if attempt < policy.retries:
+                stats.count('tile_retries')
+                time.sleep(policy.delay(attempt, retry_after))
+        download.error = error
 
-    def wait(self):
-         """Waits until every download has been processed"""
-         self.queue.join()
+    def request(self, download, i):
+        """Sends one request to mirror i of download. Returns (result,
+           error, retryable, retry_after), result is (content type, data)
+           or None."""
+        url = download.urls[i]
+        policy = download.policy
+        limiter = self.limiter(url, policy)
+        result = None
+        error = None
+        retryable = True
+        throttled = False
+        retry_after = None
+        limiter.acquire()
+        start = time.time()
+        try:
+            r = self.manager.request(method='GET', url=url, headers=download.headers,
+                                     preload_content=False, retries=NO_RETRIES)
+            try:
+                if r.status == 200:
+                    result = (r.headers.get('Content-Type'), r.read())
+                else:
+                    error = "HTTP status %d" % r.status
+                    retryable = r.status in RETRY_STATUSES
+                    throttled = r.status in THROTTLE_STATUSES
+                    retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            finally:
+                # read rest of error body and return connection to the
+                # pool for the next tile
+                r.drain_conn()
+                r.release_conn()
+        except urllib3.exceptions.HTTPError as e:
+            # connection errors and timeouts, host may be overloaded
+            throttled = True
+            error = str(e)
+        finally:
+            latency = time.time() - start
+            limiter.release(throttled, latency, policy.latency)
+        download.mirrors.record(i, latency, result is not None)
+        stats.count('tile_requests')
+        if result is None:
+            stats.count('tile_request_errors')
+        else:
+            stats.count('tile_bytes', len(result[1]))
+            stats.sample('tile_latency', latency)
+        return result, error, retryable, retry_after
+
+    def limiter(self, url, policy):
+        """Returns HostLimiter of url's host with policy's bounds."""
+        host = urlparse.urlsplit(url).netloc
+        max_limit = min(policy.max_concurrency or self.concurrency, self.concurrency)
+        min_limit = min(policy.min_concurrency, max_limit)
+        with self.limiters_lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limiter = self.limiters[host] = HostLimiter(min_limit, max_limit)
+        if (limiter.min_limit, limiter.max_limit) != (min_limit, max_limit):
+            limiter.set_bounds(min_limit, max_limit)
+        return limiter
+
+    def batch(self, callback=None):
+        """Returns new DownloadBatch using this downloader."""
+        return DownloadBatch(self, callback)
+
+    def close(self):
+        """Stops threads after queued downloads are done."""
+        for i in range(self.concurrency):
+            self.queue.put(None)
+        self.hedger.stop()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def get_downloader(concurrency=None):
+    """Returns downloader shared by the process. It is created on first
+       call, or again if concurrency changes or the process has forked."""
+    global _shared
+    with _shared_lock:
+        if concurrency is None:
+            concurrency = _shared.concurrency if _shared is not None else DEFAULT_CONCURRENCY
+        if _shared is None or _shared.pid != os.getpid():
+            # threads of parent process do not exist after fork
+            _shared = Downloader(concurrency)
+        elif _shared.concurrency != concurrency:
+            _shared.close()
+            _shared = Downloader(concurrency)
+        return _shared
@@ -0,0 +1,133 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Geometry functions for area paths given as N x 2 NumPy arrays.
+"""
+
+from __future__ import division
+import heapq
+import numpy
+
+def simplify_douglas_peucker(points, tolerance):
+    """Simplifies path with Douglas-Peucker algorithm. Points further
+       than tolerance from the simplified line are kept."""
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return points
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while len(stack):
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a = points[first]
+        d = points[last] - a
+        between = points[first + 1:last] - a
+        length = numpy.hypot(d[0], d[1])
+        if length == 0:
+            # closed path, distance from the point
+            dist = numpy.hypot(between[:, 0], between[:, 1])
+        else:
+            dist = numpy.abs(d[0] * between[:, 1] - d[1] * between[:, 0]) / length
+        i = int(numpy.argmax(dist))
+        if dist[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            stack.append((first, i))
+            stack.append((i, last))
+    return points[keep]
+
+def simplify_visvalingam(points, tolerance):
+    """Simplifies path with Visvalingam-Whyatt algorithm. Points making
+       a triangle smaller than tolerance squared with their neighbours
+       are removed."""
+    n = len(points)
+    if n < 4 or tolerance <= 0:
+        return points
+    min_area = tolerance * tolerance
+    prevs = list(range(-1, n - 1))
+    nexts = list(range(1, n + 1))
+    areas = [None] * n
+    removed = numpy.zeros(n, dtype=bool)
+    # plain lists are faster than arrays for item access
+    xs = points[:, 0].tolist()
+    ys = points[:, 1].tolist()
+
+    def area(i):
+        a, c = prevs[i], nexts[i]
+        return abs((xs[i] - xs[a]) * (ys[c] - ys[a]) - (xs[c] - xs[a]) * (ys[i] - ys[a])) / 2
+
+    heap = []
+    for i in range(1, n - 1):
+        areas[i] = area(i)
+        heap.append((areas[i], i))
+    heapq.heapify(heap)
+
+    while len(heap):
+        a, i = heapq.heappop(heap)
+        if removed[i] or a != areas[i]:
+            # already removed or area has changed
+            continue
+        if a >= min_area:
+            break
+        removed[i] = True
+        p, q = prevs[i], nexts[i]
+        nexts[p] = q
+        prevs[q] = p
+        # area of a neighbour never gets smaller than removed area
+        for j in (p, q):
+            if 0 < j < n - 1:
+                areas[j] = max(area(j), a)
+                heapq.heappush(heap, (areas[j], j))
+    return points[~removed]
+
+def clip_polygon(points, minx, miny, maxx, maxy):
+    """Clips closed polygon to rectangle with Sutherland-Hodgman algorithm.
+       Returns empty array if polygon is outside the rectangle."""
+    for axis, value, keep_greater in ((0, minx, True), (0, maxx, False),
+                                      (1, miny, True), (1, maxy, False)):
+        if len(points) == 0:
+            break
+        points = _clip_polygon_edge(points, axis, value, keep_greater)
+    return points
+
+def _clip_polygon_edge(points, axis, value, keep_greater):
+    """Clips polygon against one rectangle edge, all points at once."""
+    if keep_greater:
+        inside = points[:, axis] >= value
+    else:
+        inside = points[:, axis] <= value
+    if inside.all():
+        return points
+    following = numpy.roll(points, -1, axis=0)
+    crossing = inside != numpy.roll(inside, -1)
+    # intersections of crossing edges with the clip edge
+    delta = following - points
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = (value - points[:, axis]) / delta[:, axis]
+    intersections = points + numpy.where(crossing, t, 0)[:, None] * delta
+    intersections[:, axis] = value
+    # every edge gives its start point if inside and intersection if crossing
+    candidates = numpy.stack((points, intersections), axis=1)
+    return candidates[numpy.column_stack((inside, crossing))]
+
+SIMPLIFY_METHODS = {
+    'dp': simplify_douglas_peucker,
+    'vw': simplify_visvalingam,
+}
@@ -64,6 +64,7 @@ Class is available under the open-source GDAL license (www.gdal.org).
 """
 
 import math
+import numpy
 
 class GlobalMercator(object):
 	"""
@@ -140,6 +141,12 @@ class GlobalMercator(object):
 	  The same projection is degined as EPSG:3785. WKT definition is in the official
 	  EPSG database.
 
+	How do I convert many coordinates at once?
+
+	  Methods ending with 'Array' accept NumPy arrays (or scalars) for
+	  coordinates and tile indexes and return arrays. Results are identical
+	  to the scalar methods, the same operations are done in the same order.
+
 	  Proj4 Text:
 	    +proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0
 	    +k=1.0 +units=m +nadgrids=@null +no_defs
@@ -275,6 +282,98 @@ class GlobalMercator(object):
 			
 		return quadKey
 
+	def LatLonToMetersArray(self, lat, lon ):
+		"Array version of LatLonToMeters"
+
+		lat = numpy.asarray(lat, dtype=float)
+		lon = numpy.asarray(lon, dtype=float)
+		mx = lon * self.originShift / 180.0
+		my = numpy.log( numpy.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+
+		my = my * self.originShift / 180.0
+		return mx, my
+
+	def MetersToLatLonArray(self, mx, my ):
+		"Array version of MetersToLatLon"
+
+		mx = numpy.asarray(mx, dtype=float)
+		my = numpy.asarray(my, dtype=float)
+		lon = (mx / self.originShift) * 180.0
+		lat = (my / self.originShift) * 180.0
+
+		lat = 180 / math.pi * (2 * numpy.arctan( numpy.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
+		return lat, lon
+
+	def ResolutionArray(self, zoom ):
+		"Array version of Resolution"
+
+		return self.initialResolution / numpy.power(2.0, zoom)
+
+	def PixelsToMetersArray(self, px, py, zoom):
+		"Array version of PixelsToMeters"
+
+		res = self.ResolutionArray( zoom )
+		mx = numpy.asarray(px) * res - self.originShift
+		my = numpy.asarray(py) * res - self.originShift
+		return mx, my
+
+	def MetersToPixelsArray(self, mx, my, zoom):
+		"Array version of MetersToPixels"
+
+		res = self.ResolutionArray( zoom )
+		px = (numpy.asarray(mx) + self.originShift) / res
+		py = (numpy.asarray(my) + self.originShift) / res
+		return px, py
+
+	def PixelsToTileArray(self, px, py):
+		"Array version of PixelsToTile"
+
+		tx = (numpy.ceil( numpy.asarray(px) / float(self.tileSize) ) - 1).astype(int)
+		ty = (numpy.ceil( numpy.asarray(py) / float(self.tileSize) ) - 1).astype(int)
+		return tx, ty
+
+	def MetersToTileArray(self, mx, my, zoom):
+		"Array version of MetersToTile"
+
+		px, py = self.MetersToPixelsArray( mx, my, zoom)
+		return self.PixelsToTileArray( px, py)
+
+	def TileBoundsArray(self, tx, ty, zoom):
+		"Array version of TileBounds"
+
+		tx = numpy.asarray(tx)
+		ty = numpy.asarray(ty)
+		minx, miny = self.PixelsToMetersArray( tx*self.tileSize, ty*self.tileSize, zoom )
+		maxx, maxy = self.PixelsToMetersArray( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
+		return ( minx, miny, maxx, maxy )
+
+	def TileLatLonBoundsArray(self, tx, ty, zoom ):
+		"Array version of TileLatLonBounds"
+
+		bounds = self.TileBoundsArray( tx, ty, zoom)
+		minLat, minLon = self.MetersToLatLonArray(bounds[0], bounds[1])
+		maxLat, maxLon = self.MetersToLatLonArray(bounds[2], bounds[3])
+
+		return ( minLat, minLon, maxLat, maxLon )
+
+	def GoogleTileArray(self, tx, ty, zoom):
+		"Array version of GoogleTile"
+
+		return numpy.asarray(tx), (numpy.power(2, zoom) - 1) - numpy.asarray(ty)
+
+	def QuadTreeArray(self, tx, ty, zoom ):
+		"Array version of QuadTree, zoom must be a single level. Returns list of quadkeys."
+
+		tx = numpy.asarray(tx, dtype=numpy.int64).ravel()
+		ty = (2**zoom - 1) - numpy.asarray(ty, dtype=numpy.int64).ravel()
+		if zoom == 0:
+			return [""] * len(tx)
+		# one column of digits per zoom level, most significant first
+		shifts = numpy.arange(zoom - 1, -1, -1)
+		digits = ((tx[:, None] >> shifts) & 1) + 2 * ((ty[:, None] >> shifts) & 1)
+		chars = (digits + ord('0')).astype(numpy.uint8)
+		return [str(quadKey.decode('ascii')) for quadKey in chars.view('S%d' % zoom).ravel()]
+
 #---------------------
 
 class GlobalGeodetic(object):
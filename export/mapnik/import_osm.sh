@@ -16,7 +16,7 @@ DUMP_FILE="/tmp/gis.sql.gz"
 # check arguments
 if [ -z "$1" ]; then
   echo "Usage: $0 FILE..."
-  echo "Example: $0 finland-latest.osm.pbf ecuador-latest.osm.pbf
+  echo "Example: $0 finland-latest.osm.pbf ecuador-latest.osm.pbf"
   exit 1
 fi
 
@@ -42,6 +42,12 @@ do
   APPEND="-a"
 done
 
+# exports rendered from the old data are not used any more,
+# TOE_RESULT_CACHE is the --result-cache directory of renderers
+if [ -n "$TOE_RESULT_CACHE" ]; then
+  python "$(dirname "$0")/resultcache.py" --invalidate "$TOE_RESULT_CACHE"
+fi
+
 # dump db to file
 echo "Dumping database to $DUMP_FILE..."
 sudo -u $POSTGRES_USER pg_dump $DB | gzip > $DUMP_FILE
@@ -0,0 +1,155 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Map viewport without Mapnik.
+
+Implements the small part of mapnik API that renderer needs when map is
+drawn from raster tiles: Box2d, Coord, Projection, ProjTransform and Map
+with zoom_to_box(), envelope() and view_transform(). Only long/lat and
+spherical mercator projections are supported, conversions are done with
+GlobalMercator.
+
+ViewTransform and latlng_to_merc_array() also transform whole NumPy arrays
+of points at once, they are used for area paths with mapnik maps too.
+"""
+
+from __future__ import division
+import numpy
+from globalmaptiles import GlobalMercator
+
+mercator = GlobalMercator()
+
+class Coord(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return 'Coord(%s,%s)' % (self.x, self.y)
+
+class Box2d(object):
+    def __init__(self, minx, miny, maxx, maxy):
+        self.minx = min(minx, maxx)
+        self.miny = min(miny, maxy)
+        self.maxx = max(minx, maxx)
+        self.maxy = max(miny, maxy)
+
+    def width(self):
+        return self.maxx - self.minx
+
+    def height(self):
+        return self.maxy - self.miny
+
+    def center(self):
+        return Coord((self.minx + self.maxx) / 2, (self.miny + self.maxy) / 2)
+
+    def __repr__(self):
+        return 'Box2d(%s,%s,%s,%s)' % (self.minx, self.miny, self.maxx, self.maxy)
+
+class Projection(object):
+    def __init__(self, params):
+        self._params = params
+        self.geographic = '+proj=longlat' in params
+        if not self.geographic and '+proj=merc' not in params:
+            raise ValueError('Unsupported projection: %s' % params)
+
+    def params(self):
+        return self._params
+
+class ProjTransform(object):
+    """Transforms Box2d and Coord between long/lat and spherical mercator."""
+    def __init__(self, source, dest):
+        self.source = source
+        self.dest = dest
+
+    def forward(self, obj):
+        if self.source.geographic == self.dest.geographic:
+            return obj
+        if self.source.geographic:
+            convert = self._lnglat_to_merc
+        else:
+            convert = self._merc_to_lnglat
+        if isinstance(obj, Box2d):
+            minx, miny = convert(obj.minx, obj.miny)
+            maxx, maxy = convert(obj.maxx, obj.maxy)
+            return Box2d(minx, miny, maxx, maxy)
+        x, y = convert(obj.x, obj.y)
+        return Coord(x, y)
+
+    def _lnglat_to_merc(self, lng, lat):
+        return mercator.LatLonToMeters(lat, lng)
+
+    def _merc_to_lnglat(self, mx, my):
+        lat, lng = mercator.MetersToLatLon(mx, my)
+        return lng, lat
+
+class ViewTransform(object):
+    """Transforms mercator Box2d and Coord to map pixels."""
+    def __init__(self, width, height, extent):
+        self.extent = extent
+        self.sx = width / extent.width()
+        self.sy = height / extent.height()
+
+    def forward(self, obj):
+        if isinstance(obj, Box2d):
+            nw = self.forward(Coord(obj.minx, obj.maxy))
+            se = self.forward(Coord(obj.maxx, obj.miny))
+            return Box2d(nw.x, nw.y, se.x, se.y)
+        return Coord((obj.x - self.extent.minx) * self.sx,
+                     (self.extent.maxy - obj.y) * self.sy)
+
+    def forward_array(self, points):
+        """Transforms N x 2 array of mercator points to map pixels."""
+        result = numpy.empty_like(points)
+        result[:, 0] = (points[:, 0] - self.extent.minx) * self.sx
+        result[:, 1] = (self.extent.maxy - points[:, 1]) * self.sy
+        return result
+
+def latlng_to_merc_array(points):
+    """Transforms N x 2 array of (lat, lng) points to (x, y) in
+       spherical mercator."""
+    mx, my = mercator.LatLonToMetersArray(points[:, 0], points[:, 1])
+    return numpy.column_stack((mx, my))
+
+class Map(object):
+    """Map of given pixel size, aspect ratio is fixed like in mapnik
+       GROW_BBOX mode."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.srs = None
+        self.extent = None
+
+    def zoom_to_box(self, box):
+        ratio1 = self.width / self.height
+        ratio2 = box.width() / box.height()
+        center = box.center()
+        width = box.width()
+        height = box.height()
+        if ratio2 > ratio1:
+            height = width / ratio1
+        elif ratio2 < ratio1:
+            width = height * ratio1
+        self.extent = Box2d(center.x - width / 2, center.y - height / 2,
+                            center.x + width / 2, center.y + height / 2)
+
+    def envelope(self):
+        return self.extent
+
+    def view_transform(self):
+        return ViewTransform(self.width, self.height, self.extent)
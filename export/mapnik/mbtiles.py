@@ -0,0 +1,354 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+MBTiles tile store, a SQLite database of tiles.
+
+https://github.com/mapbox/mbtiles-spec
+
+MBTiles rows are TMS tile rows, counted from the bottom like the tile
+coordinates used inside the renderer, so tiles are stored and looked up
+without flipping. XYZ (Google) rows are converted with
+GlobalMercator.GoogleTile, which flips the row in both directions.
+
+MBTiles is used as an offline tile source with mbtiles:// URL in
+tiles.json, and MBTilesCache keeps a persistent tile cache in one MBTiles
+file per tile source. Readers use memory-mapped, query-only connections,
+writes are batched in one transaction.
+
+Total bytes of tile data are kept up to date by triggers in metadata
+(SIZE_KEY), so the cache size is known without reading every tile. Files
+are in WAL mode, close() checkpoints the log into the file, so the file
+alone can be copied.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import sqlite3
+import threading
+from globalmaptiles import GlobalMercator
+from tilecache import makedirs, Leases, DEFAULT_MAX_SIZE, LEASE_DIR
+
+MBTILES_SCHEME = 'mbtiles://'
+
+# bytes of database mapped to memory by readers
+MMAP_SIZE = 256 * 1024 * 1024
+# seconds to wait for lock of another writer
+BUSY_TIMEOUT = 30
+# metadata row of total bytes of tile data
+SIZE_KEY = 'toe_tile_bytes'
+# tiles removed in one transaction when evicting
+EVICT_CHUNK = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name);
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+    downloaded INTEGER, used INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+CREATE INDEX IF NOT EXISTS tile_used_index ON tiles (used);
+INSERT INTO metadata (name, value)
+    SELECT '%(size)s', (SELECT CAST(TOTAL(LENGTH(tile_data)) AS INTEGER) FROM tiles)
+    WHERE NOT EXISTS (SELECT 1 FROM metadata WHERE name = '%(size)s');
+CREATE TRIGGER IF NOT EXISTS tile_insert_size AFTER INSERT ON tiles BEGIN
+    UPDATE metadata SET value = value + LENGTH(NEW.tile_data) WHERE name = '%(size)s';
+END;
+CREATE TRIGGER IF NOT EXISTS tile_delete_size AFTER DELETE ON tiles BEGIN
+    UPDATE metadata SET value = value - LENGTH(OLD.tile_data) WHERE name = '%(size)s';
+END;
+CREATE TRIGGER IF NOT EXISTS tile_update_size AFTER UPDATE OF tile_data ON tiles BEGIN
+    UPDATE metadata SET value = value + LENGTH(NEW.tile_data) - LENGTH(OLD.tile_data)
+        WHERE name = '%(size)s';
+END;
+""" % { 'size': SIZE_KEY }
+
+class MBTiles(object):
+    def __init__(self, filename, readonly=True, metadata=None):
+        """Opens MBTiles file. Writable file is created if it does not
+           exist, metadata dict is saved to new file."""
+        self.filename = filename
+        self.readonly = readonly
+        self.mercator = GlobalMercator()
+        self.lock = threading.Lock()
+        self.reader = None
+        self.writer = None
+        if readonly:
+            if not os.path.exists(filename):
+                raise IOError("MBTiles file %s does not exist" % filename)
+        else:
+            created = not os.path.exists(filename)
+            self._get_writer()
+            if created and metadata:
+                self.set_metadata(metadata)
+
+    def _connect(self):
+        # connections are shared by download threads, calls are serialized
+        # with lock
+        db = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        db.text_factory = str
+        return db
+
+    def _get_reader(self):
+        if self.reader is None:
+            self.reader = self._connect()
+            self.reader.execute("PRAGMA mmap_size=%d" % MMAP_SIZE)
+            self.reader.execute("PRAGMA query_only=1")
+        return self.reader
+
+    def _get_writer(self):
+        if self.readonly:
+            raise IOError("MBTiles file %s is read-only" % self.filename)
+        if self.writer is None:
+            makedirs(os.path.dirname(os.path.abspath(self.filename)))
+            # processes opening a new file at once would race creating it
+            lock = open(self.filename + '.lock', 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.writer = self._connect()
+                # readers of other processes are not blocked by writes
+                self.writer.execute("PRAGMA journal_mode=WAL")
+                # rows replaced by INSERT OR REPLACE fire delete trigger
+                # keeping size up to date
+                self.writer.execute("PRAGMA recursive_triggers=1")
+                self.writer.executescript(SCHEMA)
+            finally:
+                lock.close()
+        return self.writer
+
+    def get(self, tx, ty, tz):
+        """Returns data of TMS tile, or None."""
+        row = self._query_one(
+                "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (tz, tx, ty))
+        if row is None:
+            return None
+        return str(row[0])
+
+    def has(self, tx, ty, tz, since=None):
+        """Tells whether TMS tile exists, and was downloaded at or after
+           since if given, without reading it."""
+        sql = "SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        args = (tz, tx, ty)
+        if since is not None:
+            sql += " AND downloaded>=?"
+            args += (since,)
+        return self._query_one(sql, args) is not None
+
+    def get_xyz(self, x, y, z):
+        """Returns data of XYZ (Google) tile, or None."""
+        tx, ty = self.mercator.GoogleTile(x, y, z)
+        return self.get(tx, ty, z)
+
+    def get_info(self, tx, ty, tz):
+        """Returns (data, download time) of TMS tile, or None."""
+        row = self._query_one(
+                "SELECT tile_data, downloaded FROM tiles "
+                "WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (tz, tx, ty))
+        if row is None:
+            return None
+        return (str(row[0]), row[1])
+
+    def _query_one(self, sql, args):
+        with self.lock:
+            return self._get_reader().execute(sql, args).fetchone()
+
+    def put_many(self, tiles, used=()):
+        """Saves list of (tx, ty, tz, data) TMS tiles in one transaction
+           and marks (tx, ty, tz) tiles in used as used now."""
+        now = int(time.time())
+        with self.lock:
+            db = self._get_writer()
+            with db:
+                db.executemany(
+                        "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, "
+                        "tile_data, downloaded, used) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(tz, tx, ty, sqlite3.Binary(data), now, now)
+                         for (tx, ty, tz, data) in tiles])
+                db.executemany(
+                        "UPDATE tiles SET used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                        [(now, tz, tx, ty) for (tx, ty, tz) in used])
+
+    def remove(self, tx, ty, tz):
+        """Removes TMS tile."""
+        with self.lock:
+            db = self._get_writer()
+            with db:
+                db.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                           (tz, tx, ty))
+
+    def set_metadata(self, metadata):
+        with self.lock:
+            db = self._get_writer()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                               metadata.items())
+
+    def size(self):
+        """Returns bytes of tile data."""
+        row = self._query_one("SELECT value FROM metadata WHERE name=?", (SIZE_KEY,))
+        if row is None:
+            # file not written by the cache
+            row = self._query_one("SELECT TOTAL(LENGTH(tile_data)) FROM tiles", ())
+        return int(float(row[0]))
+
+    def remove_least_used(self, size):
+        """Removes least recently used tiles having at least size bytes.
+           Tiles are removed EVICT_CHUNK at a time, so that other writers
+           are not blocked for long."""
+        removed = 0
+        while removed < size:
+            with self.lock:
+                db = self._get_writer()
+                with db:
+                    rows = db.execute("SELECT rowid, LENGTH(tile_data) FROM tiles "
+                                      "ORDER BY used LIMIT ?", (EVICT_CHUNK,)).fetchall()
+                    ids = []
+                    for rowid, tile_size in rows:
+                        if removed >= size:
+                            break
+                        ids.append((rowid,))
+                        removed += tile_size
+                    db.executemany("DELETE FROM tiles WHERE rowid=?", ids)
+            if len(rows) < EVICT_CHUNK:
+                break
+        return removed
+
+    def close(self):
+        """Closes connections. Log of writer is checkpointed into the file,
+           so that the file can be copied alone."""
+        with self.lock:
+            if self.writer is not None:
+                try:
+                    self.writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    sys.stderr.write("Could not checkpoint %s: %s\n" % (self.filename, str(e)))
+            for db in (self.reader, self.writer):
+                if db is not None:
+                    db.close()
+            self.reader = None
+            self.writer = None
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+def open_source(url):
+    """Returns read-only MBTiles of mbtiles:// url, kept open between
+       renders of the process."""
+    filename = url[len(MBTILES_SCHEME):]
+    key = (filename, os.getpid())
+    with _sources_lock:
+        if key not in _sources:
+            # connections of parent process can not be used after fork
+            _sources[key] = MBTiles(filename)
+        return _sources[key]
+
+class MBTilesCache(object):
+    """Persistent tile cache with one MBTiles file per tile source,
+       same interface as TileCache."""
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stores = {}
+        # tiles read from cache, saved as used by put_many()
+        self.used = {}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        makedirs(cache_dir)
+        self.leases = Leases(os.path.join(cache_dir, LEASE_DIR))
+
+    def _store(self, source):
+        with self.lock:
+            if self.pid != os.getpid():
+                # connections of parent process can not be used after fork
+                self.stores = {}
+                self.used = {}
+                self.pid = os.getpid()
+            if source not in self.stores:
+                filename = os.path.join(self.cache_dir, "%s.mbtiles" % source)
+                self.stores[source] = MBTiles(filename, False, {
+                    'name': source, 'type': 'baselayer', 'version': '1.0',
+                    'description': 'TOE tile cache', 'format': 'png' })
+            return self.stores[source]
+
+    def get(self, source, tx, ty, tz, ttl=None):
+        """Returns data of cached tile, or None if tile is missing
+           or older than ttl seconds."""
+        info = self._store(source).get_info(tx, ty, tz)
+        if info is None:
+            return None
+        data, downloaded = info
+        if ttl is not None and time.time() - (downloaded or 0) > ttl:
+            return None
+        with self.lock:
+            self.used.setdefault(source, []).append((tx, ty, tz))
+        return data
+
+    def has(self, source, tx, ty, tz, ttl=None):
+        """Tells whether tile is cached and not older than ttl seconds,
+           without reading it or marking it used."""
+        since = time.time() - ttl if ttl is not None else None
+        return self._store(source).has(tx, ty, tz, since)
+
+    def put(self, source, tx, ty, tz, data):
+        """Saves tile data to cache."""
+        self.put_many(source, [(tx, ty, tz, data)])
+
+    def put_many(self, source, tiles):
+        """Saves list of (tx, ty, tz, data) tiles in one transaction."""
+        store = self._store(source)
+        with self.lock:
+            used = self.used.pop(source, [])
+        try:
+            store.put_many(tiles, used)
+        except sqlite3.Error as e:
+            # export works without cache
+            sys.stderr.write("Could not save tiles to cache: %s\n" % str(e))
+
+    def remove(self, source, tx, ty, tz):
+        """Removes tile from cache."""
+        self._store(source).remove(tx, ty, tz)
+
+    def evict(self):
+        """Removes least recently used tiles of every tile source until
+           cache fits in max_size."""
+        sources = [name[:-len('.mbtiles')] for name in os.listdir(self.cache_dir)
+                   if name.endswith('.mbtiles')]
+        stores = [self._store(source) for source in sources]
+        try:
+            sizes = [store.size() for store in stores]
+            size = sum(sizes)
+            if size <= self.max_size:
+                return
+            # remove from every source in proportion to its size
+            excess = size - self.max_size
+            for store, store_size in zip(stores, sizes):
+                store.remove_least_used(excess * store_size // size + 1)
+        except sqlite3.Error as e:
+            sys.stderr.write("Could not evict tiles from cache: %s\n" % str(e))
+
+    def close(self):
+        """Closes MBTiles files of tile sources."""
+        with self.lock:
+            stores = self.stores.values()
+            self.stores = {}
+        for store in stores:
+            store.close()
@@ -0,0 +1,153 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Mirror url templates of one tile source and their statistics.
+
+"url" of a tile source in tiles.json may be a list of templates, and
+{s} in a template is replaced by each of "subdomains" (default "abc"),
+every resulting template is a mirror. Requests are spread over mirrors
+round-robin, skipping mirrors that fail often or respond much slower than
+the fastest one, except for an occasional probe. Latencies of successful
+responses also give the delay after which downloader sends a hedged
+request to another mirror.
+"""
+
+from __future__ import division
+import os
+import threading
+import collections
+
+DEFAULT_SUBDOMAINS = 'abc'
+# weight of the latest response in moving error rate
+ALPHA = 0.2
+# latencies of one mirror kept for its median
+MIRROR_SAMPLES = 50
+# mirrors failing more often or slower than SLOW_FACTOR times the fastest
+# mirror are skipped
+MAX_ERROR_RATE = 0.5
+SLOW_FACTOR = 3
+# every PROBE_INTERVAL'th request may go to a skipped mirror
+PROBE_INTERVAL = 20
+# latencies kept for hedge delay, and needed before hedging
+MAX_SAMPLES = 200
+MIN_SAMPLES = 20
+
+class Mirror(object):
+    def __init__(self, template):
+        self.template = template
+        self.requests = 0
+        self.errors = 0
+        self.error_rate = 0.0
+        # median of recent latencies, not thrown off by a few slow ones
+        self.latency = None
+        self.latencies = collections.deque(maxlen=MIRROR_SAMPLES)
+
+    def score(self):
+        """Expected cost of a request, smaller is better."""
+        return (self.latency or 0) / max(1 - self.error_rate, 0.1)
+
+    def __repr__(self):
+        return 'Mirror(%s, %d requests, %d errors, %.3f s)' % (
+            self.template, self.requests, self.errors, self.latency or 0)
+
+class MirrorSet(object):
+    def __init__(self, url, subdomains=None):
+        """url is a template or list of templates."""
+        if isinstance(url, basestring):
+            url = [url]
+        if subdomains is None:
+            subdomains = DEFAULT_SUBDOMAINS
+        self.mirrors = []
+        for template in url:
+            if '{s}' in template:
+                self.mirrors.extend(Mirror(template.replace('{s}', s)) for s in subdomains)
+            else:
+                self.mirrors.append(Mirror(template))
+        self.templates = [mirror.template for mirror in self.mirrors]
+        self.latencies = collections.deque(maxlen=MAX_SAMPLES)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def choose(self, exclude=(), fastest=False):
+        """Returns index of mirror for next request, other than those in
+           exclude if possible. Mirrors take turns unless fastest is
+           set."""
+        with self.lock:
+            candidates = [i for i in range(len(self.mirrors)) if i not in exclude]
+            if not candidates:
+                candidates = range(len(self.mirrors))
+            if fastest:
+                return min(candidates, key=lambda i: self.mirrors[i].score())
+            self.count += 1
+            if self.count % PROBE_INTERVAL:
+                candidates = self._healthy(candidates) or candidates
+            return candidates[self.count % len(candidates)]
+
+    def _healthy(self, candidates):
+        latencies = [self.mirrors[i].latency for i in candidates
+                     if self.mirrors[i].latency is not None]
+        max_latency = min(latencies) * SLOW_FACTOR if latencies else None
+        return [i for i in candidates
+                if self.mirrors[i].error_rate <= MAX_ERROR_RATE and
+                (max_latency is None or self.mirrors[i].latency is None or
+                 self.mirrors[i].latency <= max_latency)]
+
+    def record(self, i, latency, ok):
+        """Records response of mirror i, latency in seconds."""
+        with self.lock:
+            mirror = self.mirrors[i]
+            mirror.requests += 1
+            mirror.error_rate += ALPHA * ((0.0 if ok else 1.0) - mirror.error_rate)
+            if not ok:
+                mirror.errors += 1
+                return
+            mirror.latencies.append(latency)
+            mirror.latency = sorted(mirror.latencies)[len(mirror.latencies) // 2]
+            self.latencies.append(latency)
+
+    def hedge_delay(self, percentile):
+        """Returns latency at percentile of recent responses, or None if
+           there are too few of them or only one mirror."""
+        with self.lock:
+            if len(self.mirrors) < 2 or len(self.latencies) < MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+_mirror_sets = {}
+_mirror_sets_pid = None
+_mirror_sets_lock = threading.Lock()
+
+def get_mirrors(url, subdomains=None):
+    """Returns MirrorSet of tile source, shared by the process so that
+       statistics are kept between renders."""
+    global _mirror_sets, _mirror_sets_pid
+    if isinstance(url, basestring):
+        url = [url]
+    key = (tuple(url), subdomains)
+    with _mirror_sets_lock:
+        if _mirror_sets_pid != os.getpid():
+            _mirror_sets = {}
+            _mirror_sets_pid = os.getpid()
+        mirrors = _mirror_sets.get(key)
+        if mirrors is None:
+            mirrors = _mirror_sets[key] = MirrorSet(url, subdomains)
+        return mirrors
@@ -0,0 +1,111 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Raster tiles of one zoom level composited into one cairo image surface.
+
+The mosaic covers a rectangle of the tile grid in tile pixels. Grid pixel
+(0, 0) is the top left corner of tile (tminx, tmaxy), TMS tile y grows
+upwards. Painting one cropped mosaic instead of every tile embeds one
+image in PDF output, without the parts of edge tiles outside the map.
+
+Tiles may be added from several threads as they are downloaded, they are
+decoded in parallel and drawn one at a time.
+
+Missing tiles can be made of tiles of other zoom levels with
+downsample_tiles() and upscale_tile().
+"""
+
+from __future__ import division
+import io
+import threading
+import cairo
+
+TILE_SIZE = 256
+
+class Mosaic(object):
+    def __init__(self, tminx, tmaxy, x, y, width, height):
+        """Mosaic covers width x height tile pixels starting from grid
+           pixel x, y."""
+        self.tminx = tminx
+        self.tmaxy = tmaxy
+        self.x = x
+        self.y = y
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.ctx = cairo.Context(self.surface)
+        self.lock = threading.Lock()
+
+    def add(self, tx, ty, data):
+        """Decodes PNG data of tile and draws it to its place."""
+        img = cairo.ImageSurface.create_from_png(io.BytesIO(data))
+        x = (tx - self.tminx) * TILE_SIZE - self.x
+        y = (self.tmaxy - ty) * TILE_SIZE - self.y
+        with self.lock:
+            self.ctx.set_source_surface(img, x, y)
+            self.ctx.paint()
+
+    def resample(self, width, height):
+        """Returns mosaic scaled to width x height pixels."""
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        ctx.scale(width / self.surface.get_width(), height / self.surface.get_height())
+        pattern = cairo.SurfacePattern(self.surface)
+        pattern.set_filter(cairo.FILTER_GOOD)
+        ctx.set_source(pattern)
+        ctx.paint()
+        return surface
+
+def downsample_tiles(children):
+    """Returns PNG data of tile made of its four children on the next
+       zoom level. children is dict of PNG data by (dx, dy), position of
+       the child in TMS tiles, dy grows upwards."""
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, TILE_SIZE, TILE_SIZE)
+    ctx = cairo.Context(surface)
+    ctx.scale(0.5, 0.5)
+    for (dx, dy), data in children.items():
+        img = cairo.ImageSurface.create_from_png(io.BytesIO(data))
+        pattern = cairo.SurfacePattern(img)
+        pattern.set_filter(cairo.FILTER_GOOD)
+        ctx.save()
+        ctx.translate(dx * TILE_SIZE, (1 - dy) * TILE_SIZE)
+        ctx.set_source(pattern)
+        ctx.paint()
+        ctx.restore()
+    return _encode_png(surface)
+
+def upscale_tile(data, levels, dx, dy):
+    """Returns PNG data of tile levels zoom levels below the tile of data,
+       cropped from it and scaled up. dx, dy is position of the tile
+       inside the bigger one in TMS tiles, dy grows upwards."""
+    img = cairo.ImageSurface.create_from_png(io.BytesIO(data))
+    n = 2 ** levels
+    size = TILE_SIZE / n
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, TILE_SIZE, TILE_SIZE)
+    ctx = cairo.Context(surface)
+    ctx.scale(n, n)
+    ctx.translate(-dx * size, -(n - 1 - dy) * size)
+    pattern = cairo.SurfacePattern(img)
+    pattern.set_filter(cairo.FILTER_GOOD)
+    ctx.set_source(pattern)
+    ctx.paint()
+    return _encode_png(surface)
+
+def _encode_png(surface):
+    output = io.BytesIO()
+    surface.write_to_png(output)
+    return output.getvalue()
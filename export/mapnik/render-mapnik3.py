@@ -5,25 +5,57 @@
 # Example:
 # cd ~/mapnik-stylesheets
 # echo '{"areas":[],"pois":[]}' | ../www/toe/export/mapnik/render.py -b "((61.477925877956785, 21.768811679687474), (61.488948601502614, 21.823743320312474))" -s 144x93
+# Run as a daemon keeping maps loaded between exports, see renderclient.py:
+# ../www/toe/export/mapnik/render-mapnik3.py --daemon /tmp/toe-render.sock
 # force divisions to use float
 from __future__ import division
 import sys, os
-import mapnik
+import math
 import cairo
+import numpy
 import json
+import copy
 import argparse
 import tempfile
-import shutil
+import time
+import collections
+import glob
+import traceback
+import resource
+import multiprocessing
+import mapview
+import geometry
+import stats
+from mosaic import Mosaic, TILE_SIZE
 from globalmaptiles import GlobalMercator
-from tileloader import GoogleTileLoader, TMSTileLoader, FTileLoader
+from tileloader import GoogleTileLoader, TMSTileLoader, FTileLoader, DEFAULT_MAX_TILES
+from renderserver import serve, open_output, close_output, stream_files
+from tilecache import TileCache, MemoryTileCache, DEFAULT_MAX_SIZE
+from mbtiles import MBTilesCache
+from resultcache import ResultCache, file_digest, OUTPUT_MODE, \
+        DEFAULT_MAX_SIZE as DEFAULT_RESULT_CACHE_SIZE
+from downloader import get_downloader, DEFAULT_CONCURRENCY
 
 #sys.stdout.write("areas: '" + str(areas) + "'\n")
 #sys.stdout.write("pois: '" + str(areas) + "'\n")
 #sys.exit(0)
 
-# ensure minimum mapnik version
-if not hasattr(mapnik,'mapnik_version') and not mapnik.mapnik_version() >= 300000:
-    raise SystemExit('This script requires Mapnik >= 3.0.0)')
+# mapnik is imported only when map is rendered with it,
+# maps drawn from tiles do not need it
+mapnik = None
+
+def import_mapnik():
+    """Imports mapnik module on first call and returns it."""
+    global mapnik
+    if mapnik is None:
+        import mapnik as module
+        # ensure minimum mapnik version
+        if not hasattr(module,'mapnik_version') and not module.mapnik_version() >= 300000:
+            raise SystemExit('This script requires Mapnik >= 3.0.0)')
+        mapnik = module
+    return mapnik
+
+DEFAULT_XML = 'mapnik.xml'
 
 # Google bounds toString() gives following string:
 # ((61.477925877956785, 21.768811679687474), (61.488948601502614, 21.823743320312474))
@@ -36,15 +68,107 @@ def googleBoundsToBox2d(google_bounds):
     max_lng = float(parts[3].strip(strip_str))
     return (min_lng, min_lat, max_lng, max_lat)
 
+# map is fitted to areas with this margin, fraction of areas' size
+FIT_MARGIN = 0.1
+# resolution of png output, screen resolution by default
+DEFAULT_DPI = 96
+# minimum fit margin in degrees
+MIN_FIT_MARGIN = 0.001
+
+# area borders are simplified for this output resolution by default
+SIMPLIFY_DPI = 600
+# area borders are clipped this many map pixels outside the map, in
+# addition to border width, so that the cut edges are never visible
+CLIP_BUFFER = 2
+
+class RenderError(Exception):
+    """Rendering failed, message is shown to the user."""
+    pass
+
+def create_output_file():
+    """Creates temporary output file and returns its name."""
+    (tmp_file_handler, tmp_file) = tempfile.mkstemp()
+    try:
+        os.fchmod(tmp_file_handler, OUTPUT_MODE)
+    finally:
+        os.close(tmp_file_handler)
+    return tmp_file
+
+def remove_files(filenames):
+    """Removes files, ignoring those already gone."""
+    for filename in filenames:
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+OUTPUT_FORMATS = ('pdf', 'svg', 'png')
+
+def parse_output_formats(value):
+    """Returns list of formats in comma separated value, such as "pdf,png"."""
+    output_formats = [f.strip().lower() for f in value.split(',') if f.strip()]
+    if not output_formats:
+        raise RenderError("No output format given.")
+    for output_format in output_formats:
+        if output_format not in OUTPUT_FORMATS:
+            raise RenderError("Unknown output format: %s" % output_format)
+    return output_formats
+
+# parsed json files by filename, kept between renders in daemon mode
+json_cache = {}
+
+def load_json(filename):
+    """Returns parsed json file, parses it again only if file has changed."""
+    filename = os.path.join(sys.path[0], filename)
+    mtime = os.path.getmtime(filename)
+    cached = json_cache.get(filename)
+    if cached is None or cached[0] != mtime:
+        f = open(filename, 'r')
+        data = f.read()
+        f.close()
+        cached = (mtime, json.loads(data))
+        json_cache[filename] = cached
+    return cached[1]
+
+
+# recorded Mapnik maps are kept at most this many seconds, so that a daemon
+# draws new map data some time after import
+BASE_MAP_TTL = 3600
+
+class BaseMapCache(object):
+    """Recordings of drawn Mapnik maps by map key, kept between renders.
+       Least recently used recordings are dropped when there are more
+       than size of them."""
+    def __init__(self, size, ttl=BASE_MAP_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.recordings = collections.OrderedDict()
+        # returns generation of imported map data, see ResultCache
+        self.generation = lambda: ''
+
+    def get(self, key):
+        """Returns recording surface of map, or None."""
+        entry = self.recordings.pop(key, None)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        self.recordings[key] = entry
+        return entry[1]
+
+    def put(self, key, recording):
+        self.recordings[key] = (time.time(), recording)
+        while len(self.recordings) > self.size:
+            self.recordings.popitem(last=False)
+
+# recorded maps kept by default, each may take a few megabytes
+BASE_MAP_CACHE_SIZE = 4
+base_maps = BaseMapCache(BASE_MAP_CACHE_SIZE)
+
 
 class TileSourceParser:
     """Parses tiles.json containing information about tile sources."""
     def __init__(self, tile_src_file, tile_source):
-        tile_src_file = os.path.join(sys.path[0], tile_src_file)
-        f = open(tile_src_file, 'r')
-        data = f.read()
-        f.close()
-        obj = json.loads(data)
+        obj = load_json(tile_src_file)
+        self.name = tile_source
         self.tiles = obj[tile_source]
 
     def get(self, key, default=None):
@@ -61,12 +185,9 @@ class StyleParser:
     DEFAULT_UNIT=UNIT_PX
 
     def __init__(self, style_file, style_name):
-        styles_file = os.path.join(sys.path[0], style_file)
-        f = open(styles_file, 'r')
-        data = f.read()
-        f.close()
-        obj = json.loads(data)
-        self.style = obj[style_name or self.DEFAULT_STYLE]
+        obj = load_json(style_file)
+        # copy, style values are changed while rendering
+        self.style = copy.deepcopy(obj[style_name or self.DEFAULT_STYLE])
 
     def get(self, key, default=None):
         return self.style.get(key, default)
@@ -123,28 +244,95 @@ class Layer(object):
         self.tiles = renderer.get_tile_source()
         self.style = renderer.get_style()
 
+    def prepare(self):
+        """Called for every layer before drawing any of them. Implement
+           in subclasses to start slow work, such as downloads, or to do
+           work that does not need the drawing context."""
+        pass
+
     def draw(self):
         """Implement this in subclasses."""
         pass
 
 class MapnikLayer(Layer):
-    """Layer for Mapnik map."""
+    """Layer for Mapnik map. Map is recorded and replayed when the same
+       map is drawn again with other areas, querying the database again
+       is the slowest part of rendering."""
     def draw(self):
         zoom = self.style.get('zoom')
         # save context
         self.ctx.save()
         self.ctx.scale(zoom, zoom)
-        mapnik.render(self.m, self.ctx)
+        if base_maps.size > 0 and hasattr(cairo, 'RecordingSurface'):
+            key = self._key()
+            recording = base_maps.get(key)
+            if recording is None:
+                stats.count('base_map_cache_misses')
+                recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                                   (0, 0, self.m.width, self.m.height))
+                with stats.stage('mapnik_render'):
+                    mapnik.render(self.m, cairo.Context(recording))
+                base_maps.put(key, recording)
+            else:
+                stats.count('base_map_cache_hits')
+                self.renderer.log("Mapnik map replayed from cache")
+            self.ctx.set_source_surface(recording, 0, 0)
+            self.ctx.paint()
+        else:
+            with stats.stage('mapnik_render'):
+                mapnik.render(self.m, self.ctx)
         # restore saved context
         self.ctx.restore()
 
+    def _key(self):
+        """Returns key of map: mapfile version, generation of map data,
+           extent and pixel size."""
+        mapfile = os.path.abspath(self.renderer.mapfile)
+        extent = self.m.envelope()
+        return (mapfile, os.path.getmtime(mapfile), base_maps.generation(),
+                (extent.minx, extent.miny, extent.maxx, extent.maxy),
+                self.m.width, self.m.height)
+
 class AreaLayer(Layer):
     """Layer for area borders."""
     def __init__(self, renderer, areas):
         super(AreaLayer, self).__init__(renderer)
         self.areas = areas
+        self.paths = None
+        self.vertices_in = 0
+        self.vertices_out = 0
+
+    def prepare(self):
+        """Projects, clips and simplifies area paths."""
+        zoom = self.style.get('zoom')
+
+        # leave out areas outside the map and clip the rest to the map,
+        # clipped edges are drawn outside the visible part
+        buffer = CLIP_BUFFER + self.style.get('area_border_width') / zoom
+        areas = self._visible_areas(buffer)
+
+        # project all paths at once
+        paths = self.renderer.latlng_to_map_paths([area['path'] for area in areas])
+        paths = [geometry.clip_polygon(points, -buffer, -buffer,
+                                       self.m.width + buffer, self.m.height + buffer)
+                 for points in paths]
+        self.vertices_in = sum(len(points) for points in paths)
+        self.renderer.log("Drawing %d of %d areas with %d vertices" %
+                          (len(areas), len(self.areas), self.vertices_in))
+        simplify = self.style.get('simplify')
+        if simplify:
+            paths = self._simplify(paths, simplify)
+        self.vertices_out = sum(len(points) for points in paths)
+        self.paths = paths
+        stats.count('areas', len(self.areas))
+        stats.count('areas_drawn', len(areas))
+        stats.count('vertices', self.vertices_in)
+        stats.count('vertices_drawn', self.vertices_out)
 
     def draw(self):
+        if self.paths is None:
+            self.prepare()
+
         # save context before zoom so we can restore it later
         self.ctx.save()
 
@@ -156,8 +344,8 @@ class AreaLayer(Layer):
         self.ctx.rectangle(0, 0, self.m.width, self.m.height)
         self.ctx.clip()
 
-        for area in self.areas:
-            self._draw_area(area)
+        for points in self.paths:
+            self._draw_area(points)
 
         # set brush color and line width
         self.ctx.set_source_rgba(self.style.get('area_border_color')[0],
@@ -170,18 +358,51 @@ class AreaLayer(Layer):
         # restore saved context
         self.ctx.restore()
 
-    def _draw_area(self, area):
-        coords = list()
-        for coord in area['path']:
-            coords.append(self.renderer.latlng_to_map(coord[0], coord[1]))
-        if len(coords) < 2:
-            pass # area has only one point?
-
-        start = coords.pop()
-        self.ctx.move_to(start.x, start.y)
-        while len(coords):
-            coord = coords.pop()
-            self.ctx.line_to(coord.x, coord.y)
+    def _visible_areas(self, buffer):
+        """Returns areas whose bounding box intersects the map grown by
+           buffer map pixels."""
+        if len(self.areas) == 0:
+            return []
+        envelope = self.m.envelope()
+        dx = envelope.width() / self.m.width * buffer
+        dy = envelope.height() / self.m.height * buffer
+        bbox = self.renderer.merc_to_lnglat(self.renderer.geo.Box2d(
+            envelope.minx - dx, envelope.miny - dy,
+            envelope.maxx + dx, envelope.maxy + dy))
+        visible = []
+        for area in self.areas:
+            if len(area['path']) == 0:
+                continue
+            path = numpy.asarray(area['path'], dtype=float)
+            min_lat, min_lng = path.min(axis=0)
+            max_lat, max_lng = path.max(axis=0)
+            if (max_lng >= bbox.minx and min_lng <= bbox.maxx and
+                max_lat >= bbox.miny and min_lat <= bbox.maxy):
+                visible.append(area)
+        return visible
+
+    def _simplify(self, paths, options):
+        """Simplifies paths, vertices closer than one output pixel
+           at given dpi are dropped."""
+        method = geometry.SIMPLIFY_METHODS[options.get('method', 'dp')]
+        dpi = options.get('dpi', SIMPLIFY_DPI)
+        # output is in points (1/72 inch), map pixels are scaled by zoom
+        tolerance = options.get('tolerance', 1.0) * 72 / dpi / self.style.get('zoom')
+        paths = [method(points, tolerance) for points in paths]
+        self.renderer.log("Area borders simplified from %d to %d vertices" %
+                          (self.vertices_in, sum(len(points) for points in paths)))
+        return paths
+
+    def _draw_area(self, points):
+        """Draws path of area from N x 2 array of map pixels."""
+        if len(points) < 2:
+            return # area has only one point?
+
+        points = points.tolist()
+        x, y = points[0]
+        self.ctx.move_to(x, y)
+        for x, y in points[1:]:
+            self.ctx.line_to(x, y)
         self.ctx.close_path()
 
 
@@ -224,11 +445,13 @@ class QRCodeLayer(Layer):
         self.ctx.restore()
 
 class CustomMapLayer(Layer):
-    def __init__(self, renderer, cache_dir):
+    def __init__(self, renderer, tile_cache):
         super(CustomMapLayer, self).__init__(renderer)
-        self.cache_dir = cache_dir
+        self.tile_cache = tile_cache
         self.mercator = GlobalMercator()
         self.tileloader = None
+        self.mosaic_layer = None
+        self.started = False
         if self.tiles is not None:
             map_envelope = self.m.envelope()
             # map_envelope is in mercator projection, convert it to
@@ -239,18 +462,26 @@ class CustomMapLayer(Layer):
             max_lon = envelope.maxx
             max_lat = envelope.maxy
 
-            width = self.m.width
+            # tiles for the output resolution, map pixels are scaled by
+            # zoom to points
+            width = self.m.width * self.style.get('zoom') / 72 * renderer.tile_dpi()
             indexing = self.tiles.get('indexing')
             max_zoom = self.tiles.get('maxZoom')
+            options = {
+                'downloader': get_downloader(renderer.download_concurrency),
+                'max_tiles':  self.tiles.get('max_tiles', DEFAULT_MAX_TILES),
+                'max_bytes':  self.tiles.get('max_bytes'),
+                'derive':     self.tiles.get('derive'),
+            }
             if indexing == 'google':
                 self.tileloader = GoogleTileLoader(
-                        min_lat, min_lon, max_lat, max_lon, width, max_zoom)
+                        min_lat, min_lon, max_lat, max_lon, width, max_zoom, **options)
             elif indexing == 'tms':
                 self.tileloader = TMSTileLoader(
-                        min_lat, min_lon, max_lat, max_lon, width, max_zoom)
+                        min_lat, min_lon, max_lat, max_lon, width, max_zoom, **options)
             elif indexing == 'f':
                 self.tileloader = FTileLoader(
-                        min_lat, min_lon, max_lat, max_lon, width, max_zoom)
+                        min_lat, min_lon, max_lat, max_lon, width, max_zoom, **options)
 
     def draw(self):
         # clip drawing area, so everything out will be clipped
@@ -262,56 +493,99 @@ class CustomMapLayer(Layer):
         if self.tileloader is not None:
             for tile in self._get_tiles():
                 tile.draw()
+            # tiles are drawn, cache may drop them now
+            if self.tile_cache is not None:
+                self.tile_cache.evict()
         self.ctx.restore()
 
-    def _get_tiles(self):
-        tiles = list()
-        url = self.tiles.get('url')
-        http_headers = self.tiles.get('http_headers')
-        tile_files = self.tileloader.download(self.cache_dir, url, http_headers)
-        if tile_files is None:
-            sys.stderr.write("Error when downloading map tiles. Please try again later.\n")
-            sys.exit(1)
-
-        for filename in tile_files:
-            tile = TileLayer(self.renderer, filename, self.mercator)
-            tiles.append(tile)
-        return tiles
+    def prepare(self):
+        """Starts downloading tiles, they are decoded and drawn to the
+           mosaic in download threads as they arrive."""
+        if self.tileloader is None or self.started:
+            return
+        self.started = True
+        tile_range = self.tileloader.tile_range(self.tile_cache, self.tiles.name,
+                                                self.tiles.get('url'), self.tiles.get('ttl'))
+        mosaic = None
+        if tile_range is not None:
+            (tminx, tminy, tmaxx, tmaxy, tz) = tile_range
+            self.renderer.log("Fetching %d tiles at zoom %d, %.2f times the map area" %
+                              ((tmaxx - tminx + 1) * (tmaxy - tminy + 1), tz,
+                               self.tileloader.overfetch))
+            mosaic = self._create_mosaic(tile_range)
+        callback = None
+        if mosaic is not None:
+            callback = lambda tx, ty, tz, data: mosaic.add(tx, ty, data)
+        self.tileloader.start(self.tile_cache, self.tiles.name, self.tiles.get('url'),
+                              self.tiles.get('http_headers'), self.tiles.get('ttl'),
+                              self.tiles.get('fetch'), callback, self.tiles.get('subdomains'))
+
+    def _create_mosaic(self, tile_range):
+        """Creates mosaic of tiles cropped to the map and MosaicLayer
+           drawing it. Returns None if tiles are outside the map."""
+        (tminx, tminy, tmaxx, tmaxy, tz) = tile_range
+
+        # top left corner of the tile grid and tile pixel size in map pixels
+        (min_lat, min_lon, max_lat, max_lon) = self.mercator.TileLatLonBounds(tminx, tmaxy, tz)
+        nw, se = self.renderer.latlng_to_map_array([(max_lat, min_lon), (min_lat, max_lon)])
+        scale = (se[0] - nw[0]) / TILE_SIZE
+
+        # crop mosaic to the map, in tile pixels
+        x0 = max(int(math.floor(-nw[0] / scale)), 0)
+        y0 = max(int(math.floor(-nw[1] / scale)), 0)
+        x1 = min(int(math.ceil((self.m.width - nw[0]) / scale)), (tmaxx - tminx + 1) * TILE_SIZE)
+        y1 = min(int(math.ceil((self.m.height - nw[1]) / scale)), (tmaxy - tminy + 1) * TILE_SIZE)
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        mosaic = Mosaic(tminx, tmaxy, x0, y0, x1 - x0, y1 - y0)
+        self.mosaic_layer = MosaicLayer(self.renderer, mosaic, nw[0] + x0 * scale,
+                                        nw[1] + y0 * scale, (x1 - x0) * scale,
+                                        (y1 - y0) * scale)
+        return mosaic
 
-class TileLayer(Layer):
+    def _get_tiles(self):
+        """Waits for tiles and returns layers to draw."""
+        self.prepare()
+        with stats.stage('tile_wait'):
+            tile_data = self.tileloader.finish()
+        if tile_data is None:
+            raise RenderError("Error when downloading map tiles. Please try again later.")
+        if self.mosaic_layer is None:
+            return []
+        return [self.mosaic_layer]
+
+class MosaicLayer(Layer):
     """Used by CustomMapLayer."""
 
-    def __init__(self, renderer, filename, mercator):
-        super(TileLayer, self).__init__(renderer)
-        self.filename = filename
-        self.mercator = mercator
-        basename = os.path.basename(filename).split('.')[0]
-        parts = basename.split('_')
-        # XYZ is part of the tile filename
-        self.tx = 0
-        self.ty = 0
-        self.tz = 0
-        if (len(parts) == 3):
-            self.tx, self.ty, self.tz = int(parts[0]), int(parts[1]), int(parts[2])
+    def __init__(self, renderer, mosaic, x, y, width, height):
+        """Mosaic is drawn to x, y in map pixels, scaled to
+           width x height."""
+        super(MosaicLayer, self).__init__(renderer)
+        self.mosaic = mosaic
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
 
     def draw(self):
-        zoom = self.style.get('zoom')
-        (min_lat, min_lon, max_lat, max_lon) = self.mercator.TileLatLonBounds(self.tx, self.ty, self.tz)
-        coord_nw = self.renderer.latlng_to_map(max_lat, min_lon)
-        coord_se = self.renderer.latlng_to_map(min_lat, max_lon)
+        surface = self.mosaic.surface
 
-        tile_width = coord_se.x - coord_nw.x
-        self.ctx.save()
+        # downsample to output resolution, map pixels are scaled by zoom
+        factor = (self.width / surface.get_width() * self.style.get('zoom') / 72 *
+                  self.renderer.tile_dpi())
+        if factor < 1:
+            surface = self.mosaic.resample(
+                    max(int(round(surface.get_width() * factor)), 1),
+                    max(int(round(surface.get_height() * factor)), 1))
 
-        # assume it is png
-        img = cairo.ImageSurface.create_from_png(self.filename)
-        zoom = tile_width / 256
-        self.ctx.scale(zoom, zoom)
-        self.ctx.set_source_surface(img, int(1 / zoom * coord_nw.x), int(1 / zoom * coord_nw.y))
+        self.ctx.save()
+        self.ctx.translate(self.x, self.y)
+        self.ctx.scale(self.width / surface.get_width(),
+                       self.height / surface.get_height())
+        self.ctx.set_source_surface(surface, 0, 0)
         self.ctx.paint()
         self.ctx.restore()
-        # free memory
-        del img
 
 
 class MapnikRenderer:
@@ -320,38 +594,188 @@ class MapnikRenderer:
     TILES_FILE="tiles.json"
     COPYRIGHT_TEXT="© OpenStreetMap contributors"
 
-    def __init__(self, areas):
+    # loaded maps by (mapfile, width, height), kept between renders
+    maps = {}
+
+    # write information about rendering to stderr
+    verbose = False
+
+    # simultaneous tile downloads
+    download_concurrency = DEFAULT_CONCURRENCY
+
+    def __init__(self, areas, tile_cache=None):
         self.areas = areas
+        # optional persistent tile cache, tiles are kept in memory otherwise
+        self.tile_cache = tile_cache
         self.tiles = None
         self.style = None
-
-        # Set up projections
+        # resolution of png output and whether pdf or svg is written,
+        # set by render()
+        self.raster_dpi = None
+        self.vector = True
+        # module providing Map, Box2d, Coord and projections,
+        # either mapnik or mapview
+        self.geo = None
+
+    def tile_dpi(self):
+        """Returns resolution of map tiles for the outputs: dpi of png,
+           and tile_dpi of style for pdf and svg, the higher of them when
+           both are written. Without tile_dpi one tile pixel is one map
+           pixel."""
+        dpis = []
+        if self.raster_dpi:
+            dpis.append(self.raster_dpi)
+        if self.vector:
+            dpis.append(self.style.get('tile_dpi') or 72 / self.style.get('zoom'))
+        return max(dpis)
+
+    def _setup_projections(self):
         # long/lat in degrees, aka ESPG:4326 and "WGS 84"
         # we get data in this projection
-        self.longlat = mapnik.Projection('+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
+        self.longlat = self.geo.Projection('+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
 
         # Map uses spherical mercator (most common target map projection of osm data imported with osm2pgsql)
-        self.merc = mapnik.Projection('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs +over')
+        self.merc = self.geo.Projection('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs +over')
 
         # transform objects (Box2d and Coord) to another projection
-        self.lnglat_to_merc_transform = mapnik.ProjTransform(self.longlat, self.merc)
-        self.merc_to_lnglat_transform = mapnik.ProjTransform(self.merc, self.longlat)
+        self.lnglat_to_merc_transform = self.geo.ProjTransform(self.longlat, self.merc)
+        self.merc_to_lnglat_transform = self.geo.ProjTransform(self.merc, self.longlat)
+
+    def render(self, xml_file, bbox, output_formats, tile_source, style_name, qrcode, fit_margin=FIT_MARGIN,
+               output=None, dpi=DEFAULT_DPI):
+        """Renders map to every format in output_formats, a list of
+           formats in OUTPUT_FORMATS or a single format. Layers are drawn
+           only once for several formats. Outputs are temporary files,
+           unless output is a writable file object for the only format.
+           Png is rendered at dpi."""
+        if isinstance(output_formats, basestring):
+            output_formats = [output_formats]
+        if output is not None and len(output_formats) > 1:
+            raise RenderError("Only one output format can be written to a stream.")
+
+        self.raster_dpi = dpi if 'png' in output_formats else None
+        self.vector = any(output_format != 'png' for output_format in output_formats)
+        self._prepare(xml_file, bbox, tile_source, style_name, fit_margin)
+
+        recording = None
+        if len(output_formats) > 1 and hasattr(cairo, 'RecordingSurface'):
+            # draw layers once and replay them to every output
+            recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                               (0, 0, self.paper_size[0], self.paper_size[1]))
+            self.ctx = cairo.Context(recording)
+            self._draw(qrcode)
+
+        self.output_files = []
+        try:
+            for output_format in output_formats:
+                if output is None:
+                    map_uri = create_output_file()
+                    self.output_files.append(map_uri)
+                else:
+                    map_uri = output
+
+                # we will render the map to cairo surface
+                surface = self._create_surface(output_format, map_uri, dpi)
+                self.ctx = cairo.Context(surface)
+                if output_format == 'png':
+                    # paper is white, not transparent
+                    self.ctx.set_source_rgb(1, 1, 1)
+                    self.ctx.paint()
+                    self.ctx.scale(dpi / 72, dpi / 72)
+                if recording is None:
+                    self._draw(qrcode)
+                else:
+                    with stats.stage('replay.' + output_format):
+                        self.ctx.set_source_surface(recording, 0, 0)
+                        self.ctx.paint()
+                with stats.stage('finish.' + output_format):
+                    if output_format == 'png':
+                        surface.write_to_png(map_uri)
+                    surface.finish()
+        except:
+            # no half-written outputs are left behind
+            remove_files(self.output_files)
+            self.output_files = []
+            raise
+        self.output_file = self.output_files[0] if self.output_files else None
+
+    def _create_surface(self, output_format, filename, dpi):
+        """Returns cairo surface writing output_format to filename or file
+           object, png surfaces are written with write_to_png()."""
+        if output_format == 'pdf':
+            return cairo.PDFSurface(filename, self.paper_size[0], self.paper_size[1])
+        elif output_format == 'svg':
+            return cairo.SVGSurface(filename, self.m.width, self.m.height)
+        elif output_format == 'png':
+            # paper size is in points, 1/72 inch
+            return cairo.ImageSurface(cairo.FORMAT_RGB24,
+                                      int(round(self.paper_size[0] * dpi / 72)),
+                                      int(round(self.paper_size[1] * dpi / 72)))
+        raise RenderError("Unknown output format: %s" % output_format)
+
+    def render_batch(self, xml_file, jobs, fit_margin=FIT_MARGIN):
+        """Renders every job as a page of one PDF file. Job is a dict
+           with areas and optional bbox, tiles, style and qrcode.
+           Map is fitted to areas when job has no bbox or fit is set."""
+        tmp_file = create_output_file()
+        self.raster_dpi = None
+        self.vector = True
+
+        try:
+            surface = None
+            for job in jobs:
+                self.areas = job.get('areas', [])
+                bbox = job.get('bbox')
+                if job.get('fit'):
+                    bbox = None
+                self._prepare(xml_file, bbox, job.get('tiles'), job.get('style'), fit_margin)
+
+                # pages may have different size and orientation
+                if surface is None:
+                    surface = cairo.PDFSurface(tmp_file, self.paper_size[0], self.paper_size[1])
+                else:
+                    surface.set_size(self.paper_size[0], self.paper_size[1])
+                self.ctx = cairo.Context(surface)
+
+                self._draw(job.get('qrcode'))
+                surface.show_page()
+
+            if surface is None:
+                raise RenderError("Nothing to render.")
+            surface.finish()
+        except:
+            remove_files([tmp_file])
+            raise
+        self.output_file = tmp_file
+
+    def _prepare(self, mapfile, bbox, tile_source, style_name, fit_margin=FIT_MARGIN):
+        """Sets up style, tile source and map for given bbox.
+           If bbox is None, map is fitted to areas."""
+        self.mapfile = mapfile
 
-    def render(self, xml_file, bbox, output_format, tile_source, style_name, qrcode):
         # parse styles
         self.style = StyleParser(self.STYLES_FILE, style_name)
 
         # parse tile sources
+        self.tiles = None
         if tile_source is not None and tile_source != 'OSM':
             self.tiles = TileSourceParser(self.TILES_FILE, tile_source)
             # force zoom 0.5 with tiles, seems to be good
             self.style.set('zoom', 0.5)
 
-        tile_cache_dir = None
-        (tmp_file_handler, tmp_file) = tempfile.mkstemp()
-        map_uri = tmp_file
+        if self.has_custom_map():
+            # map is drawn from tiles, stylesheet is not loaded at all
+            geo = mapview
+        else:
+            geo = import_mapnik()
+        if geo is not self.geo:
+            self.geo = geo
+            self._setup_projections()
 
-        map_bounds = self.googleBoundsToBox2d(bbox)
+        if bbox is None:
+            map_bounds = self.fit_bbox(fit_margin)
+        else:
+            map_bounds = self.googleBoundsToBox2d(bbox)
 
         # Our bounds above are in long/lat, but our map
         # is in spherical mercator, so we need to transform
@@ -368,12 +792,10 @@ class MapnikRenderer:
         self.zoom = self.style.get('zoom')
         self.zoom_f = 1 / self.zoom # zoom factor
 
-        self.m = mapnik.Map(int(self.zoom_f * self.map_size[0]),
-                             int(self.zoom_f * self.map_size[1]))
-        mapnik.load_map(self.m, xml_file)
-
-        # ensure the target map projection is mercator
-        self.m.srs = self.merc.params()
+        with stats.stage('load_map'):
+            self.m = self._load_map(mapfile,
+                                    int(self.zoom_f * self.map_size[0]),
+                                    int(self.zoom_f * self.map_size[1]))
 
         # Mapnik internally will fix the aspect ratio of the bounding box
         # to match the aspect ratio of the target image width and height
@@ -384,14 +806,12 @@ class MapnikRenderer:
         # Note: aspect_fix_mode is only available in Mapnik >= 0.6.0
         self.m.zoom_to_box(self.merc_bbox)
 
-        # we will render the map to cairo surface
-        surface = None
-        if output_format == 'pdf':
-            surface = cairo.PDFSurface(map_uri, self.paper_size[0], self.paper_size[1])
-        elif output_format == 'svg':
-            surface = cairo.SVGSurface(map_uri, self.m.width, self.m.height)
-        self.ctx = cairo.Context(surface)
+        # mercator to map pixels, same as m.view_transform() but
+        # transforms whole arrays
+        self.view = mapview.ViewTransform(self.m.width, self.m.height, self.m.envelope())
 
+    def _draw(self, qrcode):
+        """Draws all layers to current context."""
         # margins
         margin = self.style.get_px('margin')
         self.ctx.translate(margin[0],
@@ -402,9 +822,7 @@ class MapnikRenderer:
 
         # map layer
         if self.has_custom_map():
-            # create temporary tile cache dir
-            tile_cache_dir = tempfile.mkdtemp()
-            layers.append(CustomMapLayer(self, tile_cache_dir))
+            layers.append(CustomMapLayer(self, self.tile_cache))
         else:
             layers.append(MapnikLayer(self))
 
@@ -424,20 +842,39 @@ class MapnikRenderer:
         if qrcode and self.style.get('qrcode', True):
             layers.append(QRCodeLayer(self, qrcode))
 
+        # start tile downloads and prepare other layers meanwhile
+        for layer in layers:
+            with stats.stage('prepare.' + type(layer).__name__):
+                layer.prepare()
+
         # draw layers
         for layer in layers:
-            layer.draw()
+            with stats.stage('draw.' + type(layer).__name__):
+                layer.draw()
 
-        surface.finish()
-        self.output_file = map_uri
+    def _load_map(self, mapfile, width, height):
+        """Returns Map of given size, mapfile is loaded only once."""
+        if self.has_custom_map():
+            return self.geo.Map(width, height)
 
-        # remove tile cache dir
-        if tile_cache_dir is not None:
-            shutil.rmtree(tile_cache_dir)
+        key = (os.path.abspath(mapfile), width, height)
+        m = self.maps.get(key)
+        if m is None:
+            m = mapnik.Map(width, height)
+            mapnik.load_map(m, mapfile)
+
+            # ensure the target map projection is mercator
+            m.srs = self.merc.params()
+            self.maps[key] = m
+        return m
 
     def get_map(self):
         return self.m
 
+    def log(self, message):
+        if self.verbose:
+            sys.stderr.write("%s\n" % message)
+
     def get_context(self):
         return self.ctx
 
@@ -450,14 +887,40 @@ class MapnikRenderer:
         min_lng = float(parts[1].strip(strip_str))
         max_lat = float(parts[2].strip(strip_str))
         max_lng = float(parts[3].strip(strip_str))
-        return mapnik.Box2d(min_lng, min_lat, max_lng, max_lat)
+        return self.geo.Box2d(min_lng, min_lat, max_lng, max_lat)
+
+    def fit_bbox(self, margin):
+        """Returns long/lat Box2d covering all areas, grown by margin
+           (fraction of the size) on every side."""
+        lats = [coord[0] for area in self.areas for coord in area['path']]
+        lngs = [coord[1] for area in self.areas for coord in area['path']]
+        if len(lats) == 0:
+            raise RenderError("Cannot fit map to areas without paths.")
+        # avoid empty bbox with single point areas
+        margin_lat = max((max(lats) - min(lats)) * margin, MIN_FIT_MARGIN)
+        margin_lng = max((max(lngs) - min(lngs)) * margin, MIN_FIT_MARGIN)
+        return self.geo.Box2d(min(lngs) - margin_lng, min(lats) - margin_lat,
+                              max(lngs) + margin_lng, max(lats) + margin_lat)
 
     def latlng_to_map(self, lat, lng):
         """Transforms given longlat Box2d or Coord to map projection."""
-        coord = mapnik.Coord(lng, lat)
+        coord = self.geo.Coord(lng, lat)
         merc_coord = self.lnglat_to_merc(coord)
         return self.merc_to_map(merc_coord)
 
+    def latlng_to_map_array(self, points):
+        """Transforms list or array of (lat, lng) points to map projection
+           at once. Returns N x 2 array."""
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        return self.view.forward_array(mapview.latlng_to_merc_array(points))
+
+    def latlng_to_map_paths(self, paths):
+        """Transforms list of (lat, lng) paths to map projection in one
+           pass. Returns list of N x 2 arrays."""
+        points = self.latlng_to_map_array([coord for path in paths for coord in path])
+        ends = numpy.cumsum([len(path) for path in paths])
+        return numpy.split(points, ends[:-1])
+
     def lnglat_to_merc(self, bbox):
         """Transforms given longlat Box2d or Coord to merc projection."""
         return self.lnglat_to_merc_transform.forward(bbox)
@@ -500,20 +963,293 @@ class MapnikRenderer:
     def get_output(self):
         return self.output_file
 
+    def get_outputs(self):
+        """Returns output files of render() in the order of formats,
+           empty if output was written to a stream."""
+        return self.output_files
+
     def has_custom_map(self):
         return self.tiles is not None
 
+def result_files(mapfile):
+    """Returns files whose changes change exports: mapfile, json files
+       and modules of the renderer."""
+    files = [mapfile, os.path.join(sys.path[0], MapnikRenderer.STYLES_FILE),
+             os.path.join(sys.path[0], MapnikRenderer.TILES_FILE)]
+    files.extend(sorted(glob.glob(os.path.join(sys.path[0], '*.py'))))
+    return files
+
+def render_cached(result_cache, tile_cache, xml_file, areas, bbox, output_formats, tile_source,
+                  style_name, qrcode, fit_margin=FIT_MARGIN, output=None, dpi=DEFAULT_DPI):
+    """Renders map to list of output formats like MapnikRenderer.render()
+       and returns output filenames in the same order, or writes the only
+       format to output file object and returns an empty list. Exports
+       found in result_cache are copied from there without rendering."""
+    if output is not None:
+        if len(output_formats) > 1:
+            raise RenderError("Only one output format can be written to a stream.")
+        output = stats.counted(output, 'output_bytes')
+    if result_cache is None:
+        r = MapnikRenderer(areas, tile_cache)
+        r.render(xml_file, bbox, output_formats, tile_source, style_name, qrcode, fit_margin, output, dpi)
+        stats.count('output_bytes', sum(os.path.getsize(filename) for filename in r.get_outputs()))
+        return r.get_outputs()
+
+    request = {
+        # without bbox map is fitted to areas with fit_margin
+        'bbox': googleBoundsToBox2d(bbox) if bbox is not None else None,
+        'tiles': tile_source,
+        'style': style_name,
+        'qrcode': file_digest(qrcode) if qrcode else None,
+        'areas': areas,
+        'fit_margin': fit_margin,
+    }
+    files = result_files(xml_file)
+    keys = []
+    for output_format in output_formats:
+        request['outputformat'] = output_format
+        request['dpi'] = dpi if output_format == 'png' else None
+        keys.append(result_cache.key(request, files))
+    ttl = None
+    if tile_source:
+        ttl = load_json(MapnikRenderer.TILES_FILE).get(tile_source, {}).get('ttl')
+    outputs = []
+    for key, output_format in zip(keys, output_formats):
+        cached = result_cache.get(key, output_format, ttl)
+        if cached is None:
+            break
+        outputs.append(cached)
+    if len(outputs) == len(output_formats):
+        stats.count('result_cache_hits')
+        if MapnikRenderer.verbose:
+            sys.stderr.write("Export found in result cache\n")
+    else:
+        stats.count('result_cache_misses')
+        # all formats are drawn at once anyway
+        for cached in outputs:
+            os.unlink(cached)
+        r = MapnikRenderer(areas, tile_cache)
+        r.render(xml_file, bbox, output_formats, tile_source, style_name, qrcode, fit_margin, dpi=dpi)
+        outputs = r.get_outputs()
+        for key, output_format, filename in zip(keys, output_formats, outputs):
+            result_cache.put(key, output_format, filename)
+    if output is not None:
+        # exports are needed as files for the cache
+        stream_files(outputs, output)
+        return []
+    stats.count('output_bytes', sum(os.path.getsize(filename) for filename in outputs))
+    return outputs
+
+def render_request(request, tile_cache, result_cache=None):
+    """Renders daemon request and returns output filenames, one per line."""
+    data = request['data']
+    output_formats = parse_output_formats(request.get('outputformat') or 'pdf')
+    stats.start()
+    try:
+        outputs = render_cached(result_cache, tile_cache, request.get('xml') or DEFAULT_XML,
+                                data['areas'], request['bbox'], output_formats,
+                                request.get('tiles'), request.get('style'), request.get('qrcode'),
+                                dpi=request.get('dpi') or DEFAULT_DPI)
+    finally:
+        stats.finish(outputformat=request.get('outputformat'), tiles=request.get('tiles'),
+                     style=request.get('style'))
+    return "\n".join(outputs)
+
+# state of batch worker process, set by init_worker()
+worker = {}
+
+def init_worker(xml_file, tile_cache, fit_margin, memory_limit):
+    """Initializes batch worker process."""
+    if memory_limit:
+        # worker fails with MemoryError instead of eating all memory
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    worker['xml_file'] = xml_file
+    # jobs of worker share downloaded tiles also without persistent cache
+    worker['tile_cache'] = tile_cache if tile_cache is not None else MemoryTileCache()
+    worker['fit_margin'] = fit_margin
+
+def render_worker_job(job):
+    """Renders job in worker process to its own PDF file.
+       Returns (output filename, error message)."""
+    r = MapnikRenderer(job.get('areas', []), worker['tile_cache'])
+    try:
+        r.render_batch(worker['xml_file'], [job], worker['fit_margin'])
+    except RenderError as e:
+        return (None, str(e))
+    except Exception as e:
+        return (None, traceback.format_exc())
+    return (r.get_output(), None)
+
+def render_parallel(xml_file, jobs, tile_cache, fit_margin, workers, jobs_per_worker, memory_limit):
+    """Renders jobs in a pool of worker processes, each job to its own
+       PDF file. Workers keep their maps loaded and are replaced after
+       jobs_per_worker jobs. Returns output filenames in job order."""
+    pool = multiprocessing.Pool(workers, init_worker,
+                                (xml_file, tile_cache, fit_margin, memory_limit),
+                                jobs_per_worker or None)
+    try:
+        results = list(pool.imap(render_worker_job, jobs))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    outputs = [output for (output, error) in results if output is not None]
+    errors = ["Job %d: %s" % (i + 1, error)
+              for i, (output, error) in enumerate(results) if error is not None]
+    if len(errors):
+        for output in outputs:
+            os.unlink(output)
+        raise RenderError("\n".join(errors))
+    return outputs
+
+def read_jobs(f, tiles, style, qrcode, fit):
+    """Yields batch jobs read from JSON lines. Given tiles, style
+       and qrcode are used for jobs without them."""
+    for line in f:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        job = json.loads(line)
+        job.setdefault('tiles', tiles)
+        job.setdefault('style', style)
+        job.setdefault('qrcode', qrcode)
+        if fit:
+            job['fit'] = True
+        yield job
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Mapnik renderer.')
-    parser.add_argument('-b', '--bbox', required=True)
-    parser.add_argument('-x', '--xml', required=False, default='mapnik.xml')
-    parser.add_argument('-f', '--outputformat', required=False, default='pdf')
+    parser.add_argument('-b', '--bbox', required=False)
+    parser.add_argument('-x', '--xml', required=False, default=DEFAULT_XML)
+    parser.add_argument('-f', '--outputformat', required=False, default='pdf',
+                        help='%s or several of them separated by commas, '
+                             'output files are written one per line' % ", ".join(OUTPUT_FORMATS))
+    parser.add_argument('-o', '--output', required=False, default=None, metavar='FILE',
+                        help='write the only output to FILE, - for stdout, '
+                             'instead of printing temporary filenames')
+    parser.add_argument('--output-fd', required=False, type=int, default=None, metavar='N',
+                        help='write the only output to open file descriptor N')
+    parser.add_argument('--dpi', required=False, type=int, default=DEFAULT_DPI,
+                        help='resolution of png output')
     parser.add_argument('-t', '--tiles', required=False, default=None)
     parser.add_argument('-s', '--style', required=False, default=None)
     parser.add_argument('-q', '--qrcode', required=False, default=None)
+    parser.add_argument('-d', '--daemon', required=False, default=None, metavar='SOCKET',
+                        help='serve render requests from Unix socket')
+    parser.add_argument('--tile-cache', required=False,
+                        default=os.environ.get('TOE_TILE_CACHE'), metavar='DIR',
+                        help='persistent tile cache directory shared by renderers')
+    parser.add_argument('--tile-cache-size', required=False, type=int,
+                        default=DEFAULT_MAX_SIZE // (1024 * 1024), metavar='MB',
+                        help='maximum size of tile cache')
+    parser.add_argument('--tile-cache-format', required=False, default='files',
+                        choices=['files', 'mbtiles'],
+                        help='keep cached tiles as PNG files or in one MBTiles file per tile source')
+    parser.add_argument('--result-cache', required=False,
+                        default=os.environ.get('TOE_RESULT_CACHE'), metavar='DIR',
+                        help='directory of rendered exports, same export is not rendered again')
+    parser.add_argument('--result-cache-size', required=False, type=int,
+                        default=DEFAULT_RESULT_CACHE_SIZE // (1024 * 1024), metavar='MB',
+                        help='maximum size of result cache')
+    parser.add_argument('--base-map-cache', required=False, type=int,
+                        default=BASE_MAP_CACHE_SIZE, metavar='N',
+                        help='Mapnik maps recorded by daemon or batch for replaying with '
+                             'other areas, 0 to disable')
+    parser.add_argument('--batch', required=False, action='store_true',
+                        help='read JSON line jobs from stdin and render them to one PDF')
+    parser.add_argument('--fit', required=False, action='store_true',
+                        help='fit map to areas instead of bbox')
+    parser.add_argument('--fit-margin', required=False, type=float, default=FIT_MARGIN,
+                        help='margin around fitted areas, fraction of their size')
+    parser.add_argument('--workers', required=False, type=int, default=0,
+                        help='render batch jobs in this many processes, each job to its own PDF, '
+                             'or daemon requests (default for daemon: number of CPUs)')
+    parser.add_argument('--worker-jobs', required=False, type=int, default=50,
+                        help='replace worker process after this many jobs or requests')
+    parser.add_argument('--worker-memory', required=False, type=int, default=0, metavar='MB',
+                        help='memory limit of worker process')
+    parser.add_argument('--download-concurrency', required=False, type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='simultaneous tile downloads and connections per tile server')
+    parser.add_argument('-v', '--verbose', required=False, action='store_true',
+                        help='write information about rendering to stderr')
+    parser.add_argument('--stats', required=False, default=None, metavar='FILE',
+                        help='append timings and counters of every render as a JSON line '
+                             'to FILE, - for stderr')
+    parser.add_argument('--profile', required=False, action='store_true',
+                        help='profile the main thread and write the results to stderr at exit')
     args = parser.parse_args()
 
+    stats.configure(args.stats)
+    if args.profile:
+        stats.start_profile()
+
+    MapnikRenderer.verbose = args.verbose
+    MapnikRenderer.download_concurrency = args.download_concurrency
+    # one render has nothing to replay
+    base_maps.size = args.base_map_cache if args.daemon is not None or args.batch else 0
+
+    tile_cache = None
+    if args.tile_cache:
+        cache_class = MBTilesCache if args.tile_cache_format == 'mbtiles' else TileCache
+        tile_cache = cache_class(args.tile_cache, args.tile_cache_size * 1024 * 1024)
+
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024)
+        # recorded maps are not replayed after import of new data
+        base_maps.generation = result_cache.generation
+
+    if args.daemon is not None:
+        # every worker process keeps its own maps loaded
+        serve(args.daemon, lambda request: render_request(request, tile_cache, result_cache),
+              args.workers or multiprocessing.cpu_count(),
+              lambda: init_worker(args.xml, tile_cache, args.fit_margin,
+                                  args.worker_memory * 1024 * 1024),
+              args.worker_jobs)
+        sys.exit(0)
+
+    if args.bbox is None and not args.batch and not args.fit:
+        parser.error('argument -b/--bbox is required')
+
+    try:
+        output_formats = parse_output_formats(args.outputformat)
+    except RenderError as e:
+        parser.error(str(e))
+    output = open_output(args.output, args.output_fd)
+    if output is not None and (len(output_formats) > 1 or args.workers > 0):
+        parser.error('--output and --output-fd take only one output')
+
+    if args.batch:
+        # every line in stdin is a job
+        jobs = read_jobs(sys.stdin, args.tiles, args.style, args.qrcode, args.fit)
+        stats.start()
+        try:
+            if args.workers > 0:
+                outputs = render_parallel(args.xml, jobs, tile_cache, args.fit_margin,
+                                          args.workers, args.worker_jobs,
+                                          args.worker_memory * 1024 * 1024)
+            else:
+                # pages share downloaded tiles also without persistent cache
+                r = MapnikRenderer([], tile_cache if tile_cache is not None else MemoryTileCache())
+                r.render_batch(args.xml, jobs, args.fit_margin)
+                outputs = [r.get_output()]
+        except RenderError as e:
+            sys.stderr.write("%s\n" % str(e))
+            sys.exit(1)
+        finally:
+            stats.finish(batch=True, workers=args.workers)
+        if output is not None:
+            stream_files(outputs, output)
+            close_output(output)
+        else:
+            sys.stdout.write("%s" % "\n".join(outputs))
+        sys.exit(0)
+
     #sys.stdout.write("'" + str(args.bbox) + "'\n")
 
     stdin_data = sys.stdin.read()
@@ -521,7 +1257,16 @@ if __name__ == "__main__":
     areas = data['areas']
     pois = data['pois']
 
-    r = MapnikRenderer(areas)
-    r.render(args.xml, args.bbox, args.outputformat, args.tiles, args.style, args.qrcode)
-    fn = r.get_output()
-    sys.stdout.write("%s" % fn)
+    stats.start()
+    try:
+        outputs = render_cached(result_cache, tile_cache, args.xml, areas, args.bbox, output_formats,
+                                args.tiles, args.style, args.qrcode, args.fit_margin,
+                                output, args.dpi)
+    except RenderError as e:
+        sys.stderr.write("%s\n" % str(e))
+        sys.exit(1)
+    finally:
+        stats.finish(outputformat=args.outputformat, tiles=args.tiles, style=args.style)
+    if output is not None:
+        close_output(output)
+    sys.stdout.write("%s" % "\n".join(outputs))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Thin client for render daemon. Takes the same arguments as render.py,
+# so it can be used as mapnik_bin in export/config.php.
+# Start the daemon first in mapnik stylesheet directory:
+# cd ~/mapnik-stylesheets
+# ../www/toe/export/mapnik/render.py --daemon /tmp/toe-render.sock
+# Example:
+# echo '{"areas":[],"pois":[]}' | ../www/toe/export/mapnik/renderclient.py -b "((61.477925877956785, 21.768811679687474), (61.488948601502614, 21.823743320312474))" -s 144x93
+import sys, os
+import json
+import argparse
+import socket
+from renderserver import DEFAULT_SOCKET, send_request, open_output, close_output
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Mapnik render daemon client.')
+    parser.add_argument('-b', '--bbox', required=True)
+    parser.add_argument('-f', '--outputformat', required=False, default='pdf')
+    parser.add_argument('-o', '--output', required=False, default=None, metavar='FILE')
+    parser.add_argument('--output-fd', required=False, type=int, default=None, metavar='N')
+    parser.add_argument('--dpi', required=False, type=int, default=None)
+    parser.add_argument('-t', '--tiles', required=False, default=None)
+    parser.add_argument('-s', '--style', required=False, default=None)
+    parser.add_argument('-q', '--qrcode', required=False, default=None)
+    parser.add_argument('-x', '--xml', required=False, default=None)
+    parser.add_argument('--socket', required=False,
+                        default=os.environ.get('TOE_RENDER_SOCKET', DEFAULT_SOCKET))
+    args = parser.parse_args()
+
+    output = open_output(args.output, args.output_fd)
+    if output is not None and ',' in args.outputformat:
+        parser.error('--output and --output-fd take only one output')
+
+    stdin_data = sys.stdin.read()
+    request = {
+        'bbox':         args.bbox,
+        'outputformat': args.outputformat,
+        'tiles':        args.tiles,
+        'style':        args.style,
+        'qrcode':       args.qrcode,
+        'xml':          args.xml,
+        'dpi':          args.dpi,
+        'data':         json.loads(stdin_data),
+    }
+
+    try:
+        response = send_request(args.socket, request, output)
+    except socket.error as e:
+        sys.stderr.write("Could not connect to render daemon at %s: %s\n" % (args.socket, str(e)))
+        sys.exit(1)
+
+    if 'error' in response:
+        sys.stderr.write("%s\n" % response['error'])
+        sys.exit(1)
+    if output is None:
+        sys.stdout.write("%s" % response['output'])
+    else:
+        close_output(output)
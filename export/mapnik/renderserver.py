@@ -0,0 +1,291 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Render daemon and client talking through a Unix socket.
+
+The daemon keeps parsed styles, tile sources and loaded Mapnik maps in
+memory between exports. Each request is one JSON line containing the same
+arguments that render.py takes from the command line, plus the data that
+is otherwise read from stdin:
+
+  {"bbox": "((61.47, 21.76), (61.48, 21.82))", "outputformat": "pdf",
+   "tiles": null, "style": "a4", "qrcode": null,
+   "data": {"areas": [], "pois": []}}
+
+"outputformat" may list several formats separated by commas, like
+"pdf,png". Response is one JSON line, either {"output": "/tmp/tmpXXXX"}
+with one output file per line in the order of formats, or
+{"error": "message"}. Output files are readable by the group of the
+daemon.
+
+With "stream": true in the request the daemon sends the outputs through
+the socket instead and removes its files. The response line then has
+"sizes" of the outputs in bytes, and the outputs follow the line one after
+another. The client needs no access to the daemon's files.
+
+Requests are served by a pool of forked worker processes sharing the
+listening socket. Each worker renders one request at a time with its own
+loaded maps, so a slow export or an idle client holds up only one worker.
+"""
+
+import sys
+import os
+import json
+import socket
+import shutil
+import time
+import errno
+import atexit
+import signal
+import tempfile
+import traceback
+import SocketServer
+
+DEFAULT_SOCKET = '/tmp/toe-render.sock'
+COPY_BUFFER_SIZE = 64 * 1024
+# seconds a client may take to send the request or read the response
+REQUEST_TIMEOUT = 30
+# seconds to wait before replacing a worker which failed
+WORKER_RESTART_DELAY = 1
+
+class RenderRequestHandler(SocketServer.StreamRequestHandler):
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            sys.stderr.write("Render request was not received in %d seconds\n" % self.timeout)
+            return
+        if not line:
+            # client only checked that the daemon is running
+            return
+        outputs = []
+        try:
+            request = json.loads(line)
+            response = { 'output': self.server.render_func(request) }
+            if request.get('stream'):
+                outputs = response['output'].split("\n")
+                response['sizes'] = [os.path.getsize(output) for output in outputs]
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc())
+            response = { 'error': str(e) }
+        try:
+            self.wfile.write(json.dumps(response) + "\n")
+            if outputs:
+                stream_files(outputs, self.wfile)
+        finally:
+            for output in outputs:
+                if os.path.exists(output):
+                    os.unlink(output)
+
+class RenderServer(SocketServer.UnixStreamServer):
+    """Serves render requests one at a time in a process, Mapnik maps are
+       not thread safe."""
+
+    def __init__(self, socket_file, render_func, mode=0660):
+        if os.path.exists(socket_file):
+            if is_running(socket_file):
+                raise socket.error("Render daemon is already running at %s" % socket_file)
+            # remove socket left behind by previous daemon
+            os.unlink(socket_file)
+        SocketServer.UnixStreamServer.__init__(self, socket_file, RenderRequestHandler)
+        # web server must be able to connect
+        os.chmod(socket_file, mode)
+        self.socket_file = socket_file
+        self.render_func = render_func
+        # workers forked from this process leave the socket file alone
+        self.pid = os.getpid()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.getpid() == self.pid and os.path.exists(self.socket_file):
+            os.unlink(self.socket_file)
+
+def is_running(socket_file):
+    """Tells whether a render daemon answers at socket_file."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_file)
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+def serve(socket_file, render_func, workers=1, init_worker=None, worker_jobs=0):
+    """Runs render daemon until interrupted or terminated.
+       render_func gets request dict and returns output filenames. Requests
+       are served by workers processes, init_worker() is called in every
+       new worker and workers are replaced after worker_jobs requests if
+       given."""
+    server = RenderServer(socket_file, render_func)
+    children = set()
+    # terminating daemon stops its workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            while len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    run_worker(server, init_worker, worker_jobs)
+                children.add(pid)
+            try:
+                (pid, status) = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            children.discard(pid)
+            if status != 0:
+                sys.stderr.write("Render worker %d failed with status %d\n" % (pid, status))
+                time.sleep(WORKER_RESTART_DELAY)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        server.server_close()
+
+def run_worker(server, init_worker, worker_jobs):
+    """Serves requests in forked worker process and exits."""
+    status = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if init_worker is not None:
+            init_worker()
+        served = 0
+        while not worker_jobs or served < worker_jobs:
+            server.handle_request()
+            served += 1
+    except KeyboardInterrupt:
+        pass
+    except:
+        sys.stderr.write(traceback.format_exc())
+        status = 1
+    finally:
+        sys.stderr.flush()
+        os._exit(status)
+
+def send_request(socket_file, request, output=None):
+    """Sends request to render daemon and returns response dict. If output
+       file object is given, outputs are streamed to it through the
+       socket."""
+    if output is not None:
+        request = dict(request, stream=True)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_file)
+        f = s.makefile('rw')
+        f.write(json.dumps(request) + "\n")
+        f.flush()
+        line = f.readline()
+        response = None
+        if line:
+            response = json.loads(line)
+            if output is not None and 'sizes' in response:
+                copy_bytes(f, output, sum(response['sizes']))
+        f.close()
+    finally:
+        s.close()
+    if response is None:
+        return { 'error': 'No response from render daemon' }
+    return response
+
+def copy_bytes(source, output, size):
+    """Copies size bytes from source to output file object."""
+    while size > 0:
+        data = source.read(min(size, COPY_BUFFER_SIZE))
+        if not data:
+            raise IOError("Render daemon closed connection")
+        output.write(data)
+        size -= len(data)
+    output.flush()
+
+def open_output(filename=None, fd=None):
+    """Returns writable file object for --output FILE, where - is stdout,
+       or --output-fd N arguments, None if neither is given. Call
+       close_output() when the export has succeeded."""
+    if fd is not None:
+        return os.fdopen(fd, 'wb')
+    if filename == '-':
+        return sys.stdout
+    if filename is not None:
+        return OutputFile(filename)
+    return None
+
+def close_output(output):
+    """Finishes output of open_output() after successful export."""
+    if isinstance(output, OutputFile):
+        output.close()
+    else:
+        output.flush()
+
+class OutputFile(object):
+    """Output written to a temporary file in the same directory, which
+       replaces the file by close(). A failed export leaves the file as it
+       was, the temporary file is removed at exit."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        (handle, self.tmp_file) = tempfile.mkstemp(
+                prefix='.%s.' % os.path.basename(filename),
+                dir=os.path.dirname(os.path.abspath(filename)))
+        # same permissions as a file created by open()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(handle, 0666 & ~umask)
+        self.file = os.fdopen(handle, 'wb')
+        atexit.register(self.discard)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """Replaces the file with the output."""
+        self.file.close()
+        os.rename(self.tmp_file, self.filename)
+        self.tmp_file = None
+
+    def discard(self):
+        """Removes the output unless it was closed."""
+        if self.tmp_file is None:
+            return
+        self.file.close()
+        try:
+            os.unlink(self.tmp_file)
+        except OSError:
+            pass
+        self.tmp_file = None
+
+def stream_files(filenames, output):
+    """Copies output files to file object and removes them."""
+    for filename in filenames:
+        f = open(filename, 'rb')
+        try:
+            shutil.copyfileobj(f, output)
+        finally:
+            f.close()
+        os.unlink(filename)
+    output.flush()
@@ -0,0 +1,186 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Cache of whole rendered exports.
+
+Output files are saved as <cache_dir>/<key>.<format>, where key is a hash
+of everything that affects the output: request arguments, areas, QR code
+image, versions of mapfile, styles and tiles files and the generation of
+map data. import_osm.sh runs "resultcache.py --invalidate <cache_dir>"
+after the database is reimported, which writes a new generation to
+<cache_dir>/generation, so old exports are not used any more and get
+evicted. File modification time tells when the export was rendered
+(used for TTL of tile sources) and access time when it was used last (used
+for LRU eviction).
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+from tilecache import makedirs, evict_lru, write_atomic
+
+# 256 MB
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+GENERATION_FILE = 'generation'
+# outputs are readable by the group of the renderer, so that a web server
+# in that group can read outputs of the render daemon
+OUTPUT_MODE = 0640
+# coordinates are rounded to this many decimals, about 1 cm in degrees,
+# so that the same areas sent again give the same key
+COORD_DECIMALS = 7
+
+def canonical(obj):
+    """Returns obj with floats rounded and tuples as lists."""
+    if isinstance(obj, float):
+        return round(obj, COORD_DECIMALS)
+    if isinstance(obj, (list, tuple)):
+        return [canonical(item) for item in obj]
+    if isinstance(obj, dict):
+        return dict((key, canonical(value)) for key, value in obj.items())
+    return obj
+
+def file_version(filename):
+    """Returns (mtime, size) of file, or None if it does not exist."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def file_digest(filename):
+    """Returns MD5 of file content, or None if it can not be read."""
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        return hashlib.md5(f.read()).hexdigest()
+    finally:
+        f.close()
+
+class ResultCache(object):
+    LOCK_FILE = '.lock'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        makedirs(cache_dir)
+
+    def generation(self):
+        """Returns generation of map data, empty if never invalidated."""
+        try:
+            f = open(os.path.join(self.cache_dir, GENERATION_FILE), 'r')
+        except IOError:
+            return ''
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+
+    def invalidate(self):
+        """Makes all cached exports stale, they are evicted later."""
+        # readers see either the old or the new generation
+        write_atomic(os.path.join(self.cache_dir, GENERATION_FILE), "%.6f\n" % time.time())
+
+    def key(self, request, files):
+        """Returns key of export from request dict and the files it was
+           rendered with."""
+        versions = dict((os.path.abspath(filename), file_version(filename))
+                        for filename in files)
+        data = json.dumps([canonical(request), canonical(versions), self.generation()],
+                          sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(data).hexdigest()
+
+    def result_file(self, key, output_format):
+        """Returns filename where export is saved."""
+        return os.path.join(self.cache_dir, "%s.%s" % (key, output_format))
+
+    def get(self, key, output_format, ttl=None):
+        """Returns copy of cached export in a new temporary file, or None
+           if export is missing or older than ttl seconds. Caller owns the
+           copy like the output of a new render."""
+        filename = self.result_file(key, output_format)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        tmp_file = None
+        try:
+            st = os.fstat(f.fileno())
+            now = time.time()
+            if ttl is not None and now - st.st_mtime > ttl:
+                return None
+            (tmp_file_handler, tmp_file) = tempfile.mkstemp()
+            os.fchmod(tmp_file_handler, OUTPUT_MODE)
+            out = os.fdopen(tmp_file_handler, 'wb')
+            try:
+                shutil.copyfileobj(f, out)
+            finally:
+                out.close()
+        except (IOError, OSError):
+            if tmp_file is not None:
+                os.unlink(tmp_file)
+            return None
+        finally:
+            f.close()
+        try:
+            # mark export used, keep modification time for ttl
+            os.utime(filename, (now, st.st_mtime))
+        except OSError:
+            # evicted meanwhile
+            pass
+        return tmp_file
+
+    def put(self, key, output_format, output_file):
+        """Saves copy of rendered output file and evicts old exports if
+           cache is full."""
+        filename = self.result_file(key, output_format)
+        tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            shutil.copyfile(output_file, tmp_file)
+            os.rename(tmp_file, filename)
+        except (IOError, OSError) as e:
+            # export works without cache
+            sys.stderr.write("Could not save export to cache: %s\n" % str(e))
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used exports until cache fits in
+           max_size."""
+        evict_lru(self.cache_dir, self.max_size, os.path.join(self.cache_dir, self.LOCK_FILE),
+                  lambda name: not name.startswith('.') and not name.endswith('.tmp')
+                  and name != GENERATION_FILE)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Result cache maintenance.')
+    parser.add_argument('--invalidate', required=True, metavar='DIR',
+                        help='make exports cached in DIR stale after import of new map data')
+    args = parser.parse_args()
+
+    ResultCache(args.invalidate).invalidate()
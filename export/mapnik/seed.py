@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Seeds persistent tile cache with tiles of a region, so that later
+# exports find them in cache. Region is a bounding box, or areas in the
+# same JSON format render.py reads from stdin, with a buffer around them.
+# Tiles already in cache are skipped, so an interrupted run continues
+# where it stopped when started again.
+# Keep the rate low on public tile servers, see their tile usage policies.
+# Run in mapnik stylesheet directory like render.py, examples:
+# ../www/toe/export/mapnik/seed.py -t OSM --tile-cache /var/cache/toe-tiles -b "((61.47, 21.76), (61.49, 21.82))" --min-zoom 10 --max-zoom 16
+# ../www/toe/export/mapnik/seed.py -t OSM --tile-cache /var/cache/toe-tiles --areas areas.json --buffer 500 --min-zoom 12 --max-zoom 17
+import sys
+import os
+import math
+import json
+import time
+import argparse
+import threading
+import numpy
+from globalmaptiles import GlobalMercator
+from geometry import clip_polygon
+from mapview import latlng_to_merc_array
+from tileloader import TILE_LOADERS, is_valid_tile
+from tilecache import TileCache, DEFAULT_MAX_SIZE
+from mbtiles import MBTilesCache, MBTILES_SCHEME
+from downloader import get_downloader, FetchPolicy
+from mirrors import get_mirrors
+
+TILES_FILE = "tiles.json"
+# tiles per second
+DEFAULT_RATE = 2.0
+DEFAULT_CONCURRENCY = 2
+# tiles queued at a time, cache is evicted and progress reported between chunks
+CHUNK_SIZE = 100
+# seconds between progress reports
+PROGRESS_INTERVAL = 5
+
+mercator = GlobalMercator()
+
+def parse_bbox(bbox):
+    """Parses "((min_lat, min_lng), (max_lat, max_lng))" like render.py."""
+    parts = [float(part.strip("() ")) for part in bbox.split(",")]
+    return tuple(parts)
+
+def bbox_tiles(loader, tz):
+    """Returns sorted list of (tx, ty) tiles covering bounding box of loader."""
+    (tminx, tminy, tmaxx, tmaxy, tz) = loader.tile_range_at(tz)
+    return [(tx, ty) for ty in range(tminy, tmaxy + 1) for tx in range(tminx, tmaxx + 1)]
+
+def area_tiles(path, buffer, tz):
+    """Returns set of (tx, ty) tiles within about buffer meters of area
+       path, which is a list of (lat, lng) points."""
+    latlngs = numpy.array(path, dtype=float)
+    points = latlng_to_merc_array(latlngs)
+    # mercator meters are ground meters scaled by 1 / cos(lat)
+    buffer = buffer / math.cos(math.radians(latlngs[:, 0].mean()))
+    minx, miny = points.min(axis=0) - buffer
+    maxx, maxy = points.max(axis=0) + buffer
+    last_tile = 2 ** tz - 1
+    tminx, tminy = [min(max(t, 0), last_tile) for t in mercator.MetersToTile(minx, miny, tz)]
+    tmaxx, tmaxy = [min(max(t, 0), last_tile) for t in mercator.MetersToTile(maxx, maxy, tz)]
+    tiles = set()
+    for ty in range(tminy, tmaxy + 1):
+        # clip to the row first, tiles of the row clip the smaller polygon
+        (x0, y0, x1, y1) = mercator.TileBounds(tminx, ty, tz)
+        row = clip_polygon(points, minx, y0 - buffer, maxx, y1 + buffer)
+        if len(row) == 0:
+            continue
+        for tx in range(tminx, tmaxx + 1):
+            (x0, y0, x1, y1) = mercator.TileBounds(tx, ty, tz)
+            if len(clip_polygon(row, x0 - buffer, y0 - buffer, x1 + buffer, y1 + buffer)):
+                tiles.add((tx, ty))
+    return tiles
+
+class Progress(object):
+    """Counts seeded tiles and reports progress and throughput to stderr."""
+    def __init__(self, total):
+        self.total = total
+        self.cached = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def done(self):
+        return self.cached + self.downloaded + self.failed
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.downloaded / elapsed
+        remaining = self.total - self.done()
+        eta = ""
+        if rate > 0 and remaining > 0:
+            eta = ", %d min left" % math.ceil(remaining / rate / 60)
+        sys.stderr.write("%d/%d tiles (%d cached, %d downloaded, %d failed), "
+                         "%.1f tiles/s, %.1f kB/s%s\n" % (
+                         self.done(), self.total, self.cached, self.downloaded,
+                         self.failed, rate, self.bytes / 1024.0 / elapsed, eta))
+
+def seed(tiles, loader, cache, source, tile_source, ttl, policy, rate, progress):
+    """Downloads (tx, ty, tz) tiles missing from cache at most rate tiles
+       per second. Every tile is saved and its lease released as soon as
+       it arrives, so renderers waiting for the tile get it at once and an
+       interrupted run loses nothing."""
+    mirrors = get_mirrors(tile_source.get('url'), tile_source.get('subdomains'))
+    headers = tile_source.get('http_headers')
+    downloader = get_downloader()
+    interval = 1.0 / rate if rate > 0 else 0
+    next_request = time.time()
+    # progress is counted from download threads
+    lock = threading.Lock()
+
+    def downloaded(key, result):
+        """Validates and saves downloaded tile, called from download thread."""
+        data = None
+        if result is not None:
+            # failed download is reported by the downloader
+            (content_type, data) = result
+            if not is_valid_tile(content_type, data):
+                sys.stderr.write("%s is not a complete PNG image\n" %
+                                 loader.tile_urls(mirrors, *key)[0])
+                data = None
+        try:
+            if data is not None:
+                cache.put(source, key[0], key[1], key[2], data)
+        finally:
+            cache.leases.release(source, *key)
+        with lock:
+            if data is None:
+                progress.failed += 1
+            else:
+                progress.downloaded += 1
+                progress.bytes += len(data)
+
+    for i in range(0, len(tiles), CHUNK_SIZE):
+        batch = downloader.batch(downloaded)
+        for (tx, ty, tz) in tiles[i:i + CHUNK_SIZE]:
+            if cache.has(source, tx, ty, tz, ttl):
+                progress.cached += 1
+                continue
+            if not cache.leases.acquire(source, tx, ty, tz):
+                # a renderer is downloading the tile to cache
+                progress.cached += 1
+                continue
+            # space requests evenly
+            delay = next_request - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_request = max(next_request, time.time()) + interval
+            batch.download((tx, ty, tz), loader.tile_urls(mirrors, tx, ty, tz), headers,
+                           policy, mirrors)
+        batch.wait()
+        # keep cache within --tile-cache-size
+        cache.evict()
+        progress.report()
+
+def region_tiles(args, loader, min_zoom, max_zoom):
+    """Returns list of (tx, ty, tz) tiles of bbox or areas, zoom level
+       at a time, row by row."""
+    areas = None
+    if args.areas is not None:
+        f = sys.stdin if args.areas == '-' else open(args.areas)
+        areas = json.load(f).get('areas', [])
+    tiles = []
+    for tz in range(min_zoom, max_zoom + 1):
+        if areas is None:
+            zoom_tiles = bbox_tiles(loader, tz)
+        else:
+            zoom_tiles = set()
+            for area in areas:
+                if len(area.get('path', [])):
+                    zoom_tiles |= area_tiles(area['path'], args.buffer, tz)
+            zoom_tiles = sorted(zoom_tiles, key=lambda tile: (tile[1], tile[0]))
+        sys.stderr.write("Zoom %d: %d tiles\n" % (tz, len(zoom_tiles)))
+        tiles.extend((tx, ty, tz) for (tx, ty) in zoom_tiles)
+    return tiles
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Seeds tile cache with tiles of a region.')
+    parser.add_argument('-t', '--tiles', required=True,
+                        help='tile source in %s' % TILES_FILE)
+    parser.add_argument('-b', '--bbox', required=False, default=None,
+                        help='region as "((min_lat, min_lng), (max_lat, max_lng))"')
+    parser.add_argument('--areas', required=False, default=None, metavar='FILE',
+                        help='region as areas in render.py input JSON, - for stdin')
+    parser.add_argument('--buffer', required=False, type=float, default=0, metavar='METERS',
+                        help='seed also tiles this close to areas')
+    parser.add_argument('--min-zoom', required=False, type=int, default=1)
+    parser.add_argument('--max-zoom', required=False, type=int, default=None,
+                        help='defaults to maxZoom of tile source')
+    parser.add_argument('--rate', required=False, type=float, default=DEFAULT_RATE,
+                        help='tiles downloaded per second, 0 for no limit')
+    parser.add_argument('--concurrency', required=False, type=int, default=DEFAULT_CONCURRENCY,
+                        help='parallel downloads')
+    parser.add_argument('--tile-cache', required=False,
+                        default=os.environ.get('TOE_TILE_CACHE'), metavar='DIR')
+    parser.add_argument('--tile-cache-size', required=False, type=int,
+                        default=DEFAULT_MAX_SIZE // (1024 * 1024), metavar='MB')
+    parser.add_argument('--tile-cache-format', required=False, default='files',
+                        choices=['files', 'mbtiles'])
+    parser.add_argument('-n', '--dry-run', required=False, action='store_true',
+                        help='only count tiles')
+    args = parser.parse_args()
+
+    if (args.bbox is None) == (args.areas is None):
+        parser.error("give either --bbox or --areas")
+    if not args.tile_cache and not args.dry_run:
+        parser.error("--tile-cache or TOE_TILE_CACHE is required")
+
+    tile_source = json.load(open(os.path.join(sys.path[0], TILES_FILE)))[args.tiles]
+    url = tile_source.get('url', '')
+    if isinstance(url, basestring) and url.startswith(MBTILES_SCHEME):
+        sys.stderr.write("%s is an offline tile source, nothing to seed\n" % args.tiles)
+        sys.exit(1)
+    max_zoom = args.max_zoom or tile_source.get('maxZoom', 18)
+    loader_class = TILE_LOADERS[tile_source.get('indexing')]
+    downloader = get_downloader(args.concurrency)
+    if args.bbox is not None:
+        (min_lat, min_lng, max_lat, max_lng) = parse_bbox(args.bbox)
+        loader = loader_class(min_lat, min_lng, max_lat, max_lng, 0, max_zoom, downloader)
+    else:
+        # only converts tiles to urls
+        loader = loader_class(0, 0, 0, 0, 0, max_zoom, downloader)
+
+    tiles = region_tiles(args, loader, args.min_zoom, max_zoom)
+    sys.stderr.write("%d tiles at zoom levels %d-%d\n" % (len(tiles), args.min_zoom, max_zoom))
+    if args.dry_run:
+        sys.exit(0)
+
+    cache_class = MBTilesCache if args.tile_cache_format == 'mbtiles' else TileCache
+    cache = cache_class(args.tile_cache, args.tile_cache_size * 1024 * 1024)
+    # polite limits of tile source apply, concurrency may only lower them
+    fetch = dict(tile_source.get('fetch') or {})
+    fetch['max_concurrency'] = min(fetch.get('max_concurrency') or args.concurrency,
+                                   args.concurrency)
+    progress = Progress(len(tiles))
+    try:
+        seed(tiles, loader, cache, args.tiles, tile_source, tile_source.get('ttl'),
+             FetchPolicy(fetch), args.rate, progress)
+    except KeyboardInterrupt:
+        progress.report(True)
+        sys.stderr.write("Interrupted, run again to continue\n")
+        sys.exit(1)
+    finally:
+        if args.tile_cache_format == 'mbtiles':
+            # seeded files can be copied without their WAL files
+            cache.close()
+    progress.report(True)
+    if progress.failed:
+        sys.exit(1)
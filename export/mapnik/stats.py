@@ -0,0 +1,206 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Timings and counters of renders.
+
+Collecting is off until configure() is given a target. Then start() begins
+a record, code doing the work marks stages with stage() and counts events
+with count() and sample(), from any thread, and finish() writes the record
+as one JSON line to the target. Stages may be nested, so their times
+overlap. CPU time is of the whole process, including download threads.
+Without a started record the calls do nothing.
+"""
+
+from __future__ import division
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+# percentiles of samples in records
+PERCENTILES = (50, 90, 99)
+# lines of profile written to stderr
+PROFILE_LINES = 40
+
+_target = None
+_current = None
+_lock = threading.Lock()
+
+def cpu_time():
+    """Returns user and system CPU time of the process in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+class Stats(object):
+    """Statistics of one render."""
+    def __init__(self):
+        self.started = time.time()
+        self.cpu = cpu_time()
+        self.stages = {}
+        self.counters = {}
+        self.samples = {}
+
+    def add_stage(self, name, wall, cpu):
+        with _lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            stage['calls'] += 1
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+
+    def count(self, name, n):
+        with _lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def sample(self, name, value):
+        with _lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def record(self):
+        """Returns statistics as a dict."""
+        with _lock:
+            percentiles = {}
+            for name, values in self.samples.items():
+                values = sorted(values)
+                summary = {'count': len(values), 'max': values[-1]}
+                for p in PERCENTILES:
+                    # nearest rank
+                    summary['p%d' % p] = values[max(int(len(values) * p / 100.0 + 0.5) - 1, 0)]
+                percentiles[name] = summary
+            return {
+                'time': self.started,
+                'wall': time.time() - self.started,
+                'cpu': cpu_time() - self.cpu,
+                'stages': dict((name, dict(stage)) for name, stage in self.stages.items()),
+                'counters': dict(self.counters),
+                'percentiles': percentiles,
+            }
+
+class Stage(object):
+    """Context manager adding its wall and CPU time to a stage."""
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_stage(self.name, time.time() - self.wall, cpu_time() - self.cpu)
+        return False
+
+class NullStage(object):
+    """Stage used when statistics are not collected."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_stage = NullStage()
+
+def configure(target):
+    """Sets where records are written: filename to append to, - for
+       stderr, or None to collect nothing."""
+    global _target
+    _target = target
+
+def start():
+    """Begins record of a render if statistics are configured."""
+    global _current
+    if _target is not None:
+        _current = Stats()
+
+def finish(**info):
+    """Ends record of a render and writes it with info fields added."""
+    global _current
+    stats = _current
+    if stats is None:
+        return
+    _current = None
+    record = stats.record()
+    record.update(info)
+    line = json.dumps(record, sort_keys=True) + "\n"
+    if _target == '-':
+        sys.stderr.write(line)
+        return
+    try:
+        f = open(_target, 'a')
+        try:
+            f.write(line)
+        finally:
+            f.close()
+    except IOError as e:
+        sys.stderr.write("Could not write statistics: %s\n" % str(e))
+
+def stage(name):
+    """Returns context manager timing stage of the current render."""
+    stats = _current
+    if stats is None:
+        return _null_stage
+    return Stage(stats, name)
+
+def count(name, n=1):
+    """Adds n to counter of the current render."""
+    stats = _current
+    if stats is not None:
+        stats.count(name, n)
+
+def sample(name, value):
+    """Adds value to samples whose percentiles are recorded, such as
+       latencies."""
+    stats = _current
+    if stats is not None:
+        stats.sample(name, value)
+
+class CountingFile(object):
+    """Writable file object counting bytes written to it."""
+    def __init__(self, f, name):
+        self.f = f
+        self.name = name
+
+    def write(self, data):
+        count(self.name, len(data))
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+def counted(f, name):
+    """Returns file object f counting bytes written in counter name of
+       the current render, f itself if nothing is collected."""
+    if _current is None:
+        return f
+    return CountingFile(f, name)
+
+def start_profile():
+    """Profiles the rest of the process with cProfile and writes the most
+       expensive functions to stderr at exit."""
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+
+    def report():
+        profile.disable()
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+    atexit.register(report)
+    profile.enable()
@@ -0,0 +1,383 @@
+"""
+Copyright 2013-2016 Tuomas Jaakola
+
+This file is part of TOE.
+
+TOE is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TOE is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with TOE.  If not, see <http://www.gnu.org/licenses/>.
+
+Persistent tile cache shared by renderer processes.
+
+Tiles are saved as <cache_dir>/<source>/<z>/<x>/<y>.png using TMS tile
+coordinates. File modification time tells when tile was downloaded (used
+for TTL) and access time tells when it was used last (used for LRU
+eviction). Tiles are written to a temporary file first and renamed, so
+readers never see half-written tiles. Tile data is read and written as
+strings, callers decode it in memory.
+
+Leases in <cache_dir>/.leases make concurrent renderers download a tile
+only once, see Leases.
+
+MemoryTileCache keeps tiles in memory for pages of a batch export when
+there is no persistent cache.
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import threading
+import collections
+
+# 512 MB
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+# 64 MB
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024
+LEASE_DIR = '.leases'
+# seconds to wait for a tile leased by another renderer
+LEASE_TIMEOUT = 30
+# seconds between checks of a lease held by another process
+LEASE_POLL_INTERVAL = 0.1
+# tiles are evicted after this many bytes are written by the process
+EVICT_BYTES = 16 * 1024 * 1024
+# or when anything was written and nobody has evicted for this many seconds
+EVICT_INTERVAL = 600
+# temporary files older than this many seconds are left by failed writes
+STALE_TMP_AGE = 3600
+
+class TileCache(object):
+    LOCK_FILE = '.lock'
+    TILE_FORMAT = 'png'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # bytes written since last eviction
+        self.written = 0
+        self.written_lock = threading.Lock()
+        makedirs(cache_dir)
+        self.leases = Leases(os.path.join(cache_dir, LEASE_DIR))
+
+    def tile_file(self, source, tx, ty, tz):
+        """Returns filename where tile is saved."""
+        return os.path.join(self.cache_dir, source, str(tz), str(tx),
+                            "%d.%s" % (ty, self.TILE_FORMAT))
+
+    def get(self, source, tx, ty, tz, ttl=None):
+        """Returns data of cached tile, or None if tile is missing
+           or older than ttl seconds."""
+        filename = self.tile_file(source, tx, ty, tz)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            st = os.fstat(f.fileno())
+            now = time.time()
+            if ttl is not None and now - st.st_mtime > ttl:
+                return None
+            data = f.read()
+            # mark tile used, keep modification time for ttl
+            os.utime(filename, (now, st.st_mtime))
+        except (IOError, OSError):
+            return None
+        finally:
+            f.close()
+        return data
+
+    def has(self, source, tx, ty, tz, ttl=None):
+        """Tells whether tile is cached and not older than ttl seconds,
+           without reading it or marking it used."""
+        try:
+            st = os.stat(self.tile_file(source, tx, ty, tz))
+        except OSError:
+            return False
+        return ttl is None or time.time() - st.st_mtime <= ttl
+
+    def put(self, source, tx, ty, tz, data):
+        """Saves tile data to cache."""
+        try:
+            write_atomic(self.tile_file(source, tx, ty, tz), data)
+        except (IOError, OSError) as e:
+            # export works without cache
+            sys.stderr.write("Could not save tile to cache: %s\n" % str(e))
+            return
+        with self.written_lock:
+            self.written += len(data)
+
+    def put_many(self, source, tiles):
+        """Saves list of (tx, ty, tz, data) tiles to cache."""
+        for (tx, ty, tz, data) in tiles:
+            self.put(source, tx, ty, tz, data)
+
+    def remove(self, source, tx, ty, tz):
+        """Removes tile from cache."""
+        try:
+            os.unlink(self.tile_file(source, tx, ty, tz))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes least recently used tiles until cache fits in max_size.
+           Walking the cache is expensive, so it is done only after
+           EVICT_BYTES are written, or after EVICT_INTERVAL since the last
+           eviction by any process. Does nothing if another process is
+           already evicting."""
+        lock_file = os.path.join(self.cache_dir, self.LOCK_FILE)
+        with self.written_lock:
+            if self.written == 0:
+                return
+            if self.written < min(EVICT_BYTES, self.max_size / 16):
+                try:
+                    if time.time() - os.path.getmtime(lock_file) < EVICT_INTERVAL:
+                        return
+                except OSError:
+                    pass
+            self.written = 0
+        evict_lru(self.cache_dir, self.max_size, lock_file,
+                  lambda name: name.endswith('.' + self.TILE_FORMAT))
+
+class MemoryTileCache(object):
+    """Tiles kept in memory as long as the cache object lives, least
+       recently used tiles are dropped beyond max_size. Same interface as
+       TileCache, without leases."""
+
+    def __init__(self, max_size=DEFAULT_MEMORY_SIZE):
+        self.max_size = max_size
+        # (source, tx, ty, tz) -> (time saved, data), least recently used first
+        self.tiles = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, source, tx, ty, tz, ttl=None):
+        """Returns data of cached tile, or None if tile is missing
+           or older than ttl seconds."""
+        key = (source, tx, ty, tz)
+        with self.lock:
+            entry = self.tiles.pop(key, None)
+            if entry is None:
+                return None
+            self.tiles[key] = entry
+        (saved, data) = entry
+        if ttl is not None and time.time() - saved > ttl:
+            return None
+        return data
+
+    def has(self, source, tx, ty, tz, ttl=None):
+        """Tells whether tile is cached and not older than ttl seconds,
+           without marking it used."""
+        entry = self.tiles.get((source, tx, ty, tz))
+        if entry is None:
+            return False
+        return ttl is None or time.time() - entry[0] <= ttl
+
+    def put(self, source, tx, ty, tz, data):
+        """Saves tile data to cache."""
+        key = (source, tx, ty, tz)
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.tiles[key] = (time.time(), data)
+            self.size += len(data)
+
+    def put_many(self, source, tiles):
+        """Saves list of (tx, ty, tz, data) tiles to cache."""
+        for (tx, ty, tz, data) in tiles:
+            self.put(source, tx, ty, tz, data)
+
+    def remove(self, source, tx, ty, tz):
+        """Removes tile from cache."""
+        with self.lock:
+            old = self.tiles.pop((source, tx, ty, tz), None)
+            if old is not None:
+                self.size -= len(old[1])
+
+    def evict(self):
+        """Removes least recently used tiles until cache fits in max_size."""
+        with self.lock:
+            while self.size > self.max_size:
+                (key, (saved, data)) = self.tiles.popitem(last=False)
+                self.size -= len(data)
+
+class Leases(object):
+    """Single-flight downloads of tiles, shared by threads and processes.
+
+    The downloader of a tile holds an exclusive flock of its lease file
+    until the tile is in cache, others wait for the lock to be released
+    and read the tile from cache. The kernel releases locks of crashed
+    processes, and waiters give up after LEASE_TIMEOUT if the holder
+    hangs. Leases of this process are also waited with events, without
+    polling."""
+    def __init__(self, lease_dir):
+        self.lease_dir = lease_dir
+        makedirs(lease_dir)
+        # open lease files and release events of leases held by this
+        # process
+        self.held = {}
+        self.lock = threading.Lock()
+
+    def lease_file(self, source, tx, ty, tz):
+        return os.path.join(self.lease_dir, "%s-%d-%d-%d" % (source, tz, tx, ty))
+
+    def acquire(self, source, tx, ty, tz):
+        """Returns True if caller should download the tile and release the
+           lease, False if somebody else is downloading it."""
+        key = (source, tx, ty, tz)
+        filename = self.lease_file(*key)
+        with self.lock:
+            if key in self.held:
+                return False
+            while True:
+                try:
+                    f = open(filename, 'a')
+                except IOError:
+                    # download without lease
+                    return True
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    f.close()
+                    return False
+                try:
+                    # file may have been released and removed before it
+                    # was locked
+                    if os.fstat(f.fileno()).st_ino == os.stat(filename).st_ino:
+                        break
+                except OSError:
+                    pass
+                f.close()
+            self.held[key] = (f, threading.Event())
+            return True
+
+    def release(self, source, tx, ty, tz):
+        """Releases lease taken with acquire()."""
+        key = (source, tx, ty, tz)
+        with self.lock:
+            held = self.held.pop(key, None)
+        if held is None:
+            return
+        f, event = held
+        try:
+            os.unlink(self.lease_file(*key))
+        except OSError:
+            pass
+        f.close()
+        event.set()
+
+    def wait(self, source, tx, ty, tz, timeout=LEASE_TIMEOUT):
+        """Waits at most timeout seconds until lease of tile is released.
+           Returns False on timeout."""
+        key = (source, tx, ty, tz)
+        with self.lock:
+            held = self.held.get(key)
+        if held is not None:
+            held[1].wait(timeout)
+            return held[1].is_set()
+        deadline = time.time() + timeout
+        while True:
+            try:
+                f = open(self.lease_file(*key), 'r')
+            except IOError:
+                # released
+                return True
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                pass
+            finally:
+                f.close()
+            if time.time() >= deadline:
+                return False
+            time.sleep(LEASE_POLL_INTERVAL)
+
+def makedirs(path):
+    """Creates directory and its parents, other processes may create them too."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def evict_lru(cache_dir, max_size, lock_file, accept):
+    """Removes least recently used files under cache_dir, whose names
+       accept(name) is true for, until they fit in max_size. Temporary
+       files left by failed writes are removed too. Does nothing if another
+       process holds lock_file."""
+    lock = open(lock_file, 'a')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        entries = []
+        size = 0
+        now = time.time()
+        for root, dirs, files in os.walk(cache_dir):
+            for name in files:
+                tmp = name.endswith('.tmp')
+                if not tmp and not accept(name):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if tmp:
+                    if now - st.st_mtime > STALE_TMP_AGE:
+                        remove_file(filename)
+                    continue
+                entries.append((st.st_atime, st.st_size, filename))
+                size += st.st_size
+        if size <= max_size:
+            return
+        entries.sort()
+        for atime, entry_size, filename in entries:
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            size -= entry_size
+            if size <= max_size:
+                break
+    finally:
+        # modification time of lock file tells when cache was evicted last
+        try:
+            os.utime(lock_file, None)
+        except OSError:
+            pass
+        lock.close()
+
+def write_atomic(filename, data):
+    """Writes data to a temporary file and renames it to filename."""
+    makedirs(os.path.dirname(filename))
+    tmp_file = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+    try:
+        f = open(tmp_file, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_file, filename)
+    except:
+        remove_file(tmp_file)
+        raise
+
+def remove_file(filename):
+    """Removes file, ignoring it if it is already gone."""
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
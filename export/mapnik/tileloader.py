@@ -21,86 +21,438 @@ http://www.maptiler.org/google-maps-coordinates-tile-bounds-projection/
 
 """
 
+from __future__ import division
 import sys
-import os
-import math
-import imghdr
+import time
+import zlib
+import struct
+import threading
+import numpy
 from globalmaptiles import GlobalMercator
-from downloader import Downloader
+from downloader import get_downloader, FetchPolicy
+from mbtiles import open_source, MBTILES_SCHEME
+from mosaic import downsample_tiles, upscale_tile
+from mirrors import get_mirrors
+from tilecache import LEASE_TIMEOUT
+import stats
+
+# first bytes of every PNG file
+PNG_MAGIC = '\x89PNG\r\n\x1a\n'
+
+# default budget of one map
+DEFAULT_MAX_TILES = 500
+# for byte budget, typical size of a map tile
+ESTIMATED_TILE_BYTES = 20 * 1024
+# zoom level with a smaller fraction of tiles cached may be replaced by
+# a cached neighbour level
+MIN_CACHED = 0.5
+
+class DerivePolicy(object):
+    """How missing tiles are made of cached tiles of other zoom levels,
+       given as "derive" object in tiles.json."""
+    DEFAULTS = {
+        'children': True,       # downsample four children of next level
+        'max_upscale': 2,       # scale up a lower level at most this much
+    }
+
+    def __init__(self, options=None):
+        for key, value in self.DEFAULTS.iteritems():
+            setattr(self, key, value)
+        for key, value in (options or {}).iteritems():
+            if key not in self.DEFAULTS:
+                raise ValueError("Unknown derive option: %s" % key)
+            setattr(self, key, value)
 
 class TileLoader(object):
     TILE_WIDTH = 256 # tile is square
-    TILE_FORMAT = 'png'
 
-    def __init__(self, min_lat, min_lon, max_lat, max_lon, width, max_zoom = 18):
+    def __init__(self, min_lat, min_lon, max_lat, max_lon, width, max_zoom = 18,
+                 downloader = None, max_tiles = DEFAULT_MAX_TILES, max_bytes = None,
+                 derive = None):
+        """Tiles cover bounding box with about width pixels horizontally,
+           at most max_tiles tiles and max_bytes estimated bytes. derive is
+           "derive" object of tile source in tiles.json."""
         self.tiles = []
         self.min_lat = min_lat
         self.min_lon = min_lon
         self.max_lat = max_lat
         self.max_lon = max_lon
         self.mercator = GlobalMercator()
-        self.downloader = Downloader()
-        # count how many horizontal tiles we need
-        self.x_tiles_needed = math.ceil(width / self.TILE_WIDTH)
+        # long-lived downloader keeps connections open between loaders
+        self.downloader = downloader if downloader is not None else get_downloader()
+        self.width = width
         self.max_zoom = max_zoom
+        self.max_tiles = max_tiles
+        self.max_bytes = max_bytes
+        self.derive = DerivePolicy(derive)
+        # number of tiles made of other zoom levels
+        self.derived = 0
+        self._cache = None
+        self._source = None
+        self._store = None
+        self._ttl = None
+        # fetched tile area / bounding box area, set by _find_tiles()
+        self.overfetch = None
+        self.tile_info = None
+
+    def download(self, cache, source, url, http_headers, ttl=None, fetch=None,
+                 subdomains=None):
+        """Downloads tiles missing from cache and returns list of
+           (tx, ty, tz, data) tuples of tiles. Tiles that could not be
+           downloaded are left out, None is returned if none could be.
+           cache is optional persistent TileCache, fetch is "fetch" object
+           of tile source in tiles.json. url may be a list of mirrors,
+           {s} in url is replaced by each of subdomains."""
+        self.start(cache, source, url, http_headers, ttl, fetch, subdomains=subdomains)
+        return self.finish()
+
+    def start(self, cache, source, url, http_headers, ttl=None, fetch=None, callback=None,
+              subdomains=None):
+        """Starts downloading tiles missing from cache, tiles nearest to
+           the centre first, and returns without waiting. callback(tx, ty,
+           tz, data) is called for every valid tile as soon as it is
+           available, also from download threads. Call finish() to wait.
+           Tiles are read from MBTiles file instead if url is mbtiles://."""
+        self._set_source(cache, source, url, ttl)
+        self._callback = callback
+        self._tiles = self._get_tile_list()
+        self._tile_data = {}
+        self._tile_urls = {}
+        self._new_tiles = []
+        # tiles leased by this loader and tiles leased by others
+        self._leased = set()
+        self._waiting = []
+        self._lock = threading.Lock()
+        self._batch = self.downloader.batch(self._downloaded)
+        stats.count('tiles', len(self._tiles))
+        if self._store is not None:
+            self._read_mbtiles(url)
+            return
+        self._http_headers = http_headers
+        self._policy = FetchPolicy(fetch)
+        self._mirrors = get_mirrors(url, subdomains)
+        leases = getattr(cache, 'leases', None)
+        for (tx, ty, tz) in self._tiles:
+            data = self._cached(tx, ty, tz, ttl)
+            if self._cache is not None:
+                stats.count('tile_cache_misses' if data is None else 'tile_cache_hits')
+            if data is None and self.derive.children:
+                # four cached children make the tile without a download
+                data = self._from_children(tx, ty, tz, ttl)
+                if data is not None:
+                    self.derived += 1
+            if data is None:
+                if leases is None:
+                    self._download_tile(tx, ty, tz)
+                elif leases.acquire(source, tx, ty, tz):
+                    self._leased.add((tx, ty, tz))
+                    self._download_tile(tx, ty, tz)
+                else:
+                    # another renderer is downloading the tile
+                    self._waiting.append((tx, ty, tz))
+                    stats.count('tiles_leased_by_others')
+            else:
+                self._add_tile((tx, ty, tz), data)
+
+    def _download_tile(self, tx, ty, tz):
+        tile_urls = self.tile_urls(self._mirrors, tx, ty, tz)
+        self._tile_urls[(tx, ty, tz)] = tile_urls[0]
+        self._batch.download((tx, ty, tz), tile_urls, self._http_headers, self._policy,
+                             self._mirrors)
+
+    def _wait_leased(self):
+        """Reads tiles leased by other renderers from cache when they are
+           released, or downloads them if they are not in cache by then."""
+        deadline = time.time() + LEASE_TIMEOUT
+        for (tx, ty, tz) in self._waiting:
+            self._cache.leases.wait(self._source, tx, ty, tz, max(deadline - time.time(), 0))
+            data = self._cache.get(self._source, tx, ty, tz, self._ttl)
+            if data is None:
+                self._download_tile(tx, ty, tz)
+            else:
+                self._add_tile((tx, ty, tz), data)
+        self._waiting = []
 
-    def download(self, cache_dir, url, http_headers):
-        """Downloads tiles and returns list of downloaded tiles."""
-        tile_files = {}
-        tiles = self._get_tile_list()
-        for (tx, ty, tz) in tiles:
-            cx, cy, cz = self._convert_tile(tx, ty, tz)
-            tile_url = url.replace('{x}', str(cx)).replace('{y}', str(cy)).replace('{z}', str(cz))
-            tile_file = self._gen_tile_file(tx, ty, tz, cache_dir)
-            self.downloader.download(tile_file, tile_url, http_headers)
-            tile_files[tile_url] = tile_file
-
-        # wait downloads to be finished
-        self.downloader.wait()
-
-        # validate all tiles
-        valid = True
-        for tile_url, tile_file in tile_files.iteritems():
-            if self.TILE_FORMAT == 'png' and imghdr.what(tile_file) != 'png':
-                sys.stderr.write("%s is not PNG image\n" % tile_url)
-                valid = False
-        if not valid:
+    def _set_source(self, cache, source, url, ttl):
+        self._cache = cache
+        self._source = source
+        self._ttl = ttl
+        self._store = None
+        if isinstance(url, basestring) and url.startswith(MBTILES_SCHEME):
+            self._store = open_source(url)
+
+    def _cached(self, tx, ty, tz, ttl=None):
+        """Returns data of tile in offline source or cache, or None."""
+        if self._store is not None:
+            return self._store.get(tx, ty, tz)
+        if self._cache is not None:
+            return self._cache.get(self._source, tx, ty, tz, ttl)
+        return None
+
+    def _has_cached(self, tx, ty, tz, ttl=None):
+        """Tells whether tile is in offline source or cache, without
+           reading it."""
+        if self._store is not None:
+            return self._store.has(tx, ty, tz)
+        if self._cache is not None:
+            return self._cache.has(self._source, tx, ty, tz, ttl)
+        return False
+
+    def _from_children(self, tx, ty, tz, ttl=None):
+        """Returns tile downsampled from its four cached children, or None."""
+        if tz >= self.max_zoom:
             return None
+        children = {}
+        for dy in (0, 1):
+            for dx in (0, 1):
+                data = self._cached(2 * tx + dx, 2 * ty + dy, tz + 1, ttl)
+                if data is None:
+                    return None
+                children[(dx, dy)] = data
+        return downsample_tiles(children)
+
+    def _derive(self, tx, ty, tz):
+        """Returns tile made of cached tiles of other zoom levels, even
+           expired ones: its children, or the nearest cached lower level
+           scaled up at most max_upscale times. Returns None if there are
+           none."""
+        data = None
+        if self.derive.children:
+            data = self._from_children(tx, ty, tz)
+        levels = 1
+        while data is None and 2 ** levels <= self.derive.max_upscale and levels <= tz:
+            parent = self._cached(tx >> levels, ty >> levels, tz - levels)
+            if parent is not None:
+                data = upscale_tile(parent, levels, tx - (tx >> levels << levels),
+                                    ty - (ty >> levels << levels))
+            levels += 1
+        if data is not None:
+            self.derived += 1
+        return data
+
+    def _read_mbtiles(self, url):
+        """Reads tiles from offline MBTiles source."""
+        for (tx, ty, tz) in self._tiles:
+            data = self._store.get(tx, ty, tz)
+            if data is None:
+                data = self._derive(tx, ty, tz)
+            if data is None:
+                sys.stderr.write("%s has no tile %d/%d/%d\n" % (url, tz, tx, ty))
+            else:
+                self._add_tile((tx, ty, tz), data)
+
+    def finish(self):
+        """Waits downloads started by start() and returns list of
+           (tx, ty, tz, data) tuples like download()."""
+        self._batch.wait()
+        if self._waiting:
+            self._wait_leased()
+            self._batch.wait()
+        if self._cache is not None:
+            # save downloaded tiles at once
+            self._cache.put_many(self._source, self._new_tiles)
+        derived = self.derived
+        if self._store is None:
+            # failed downloads
+            for (tx, ty, tz) in self._tiles:
+                if (tx, ty, tz) not in self._tile_data:
+                    data = self._derive(tx, ty, tz)
+                    if data is not None:
+                        self._add_tile((tx, ty, tz), data)
+        valid_tiles = []
+        for key in self._tiles:
+            data = self._tile_data.get(key)
+            if data is not None:
+                valid_tiles.append(key + (data,))
 
-        return tile_files.values()
+        stats.count('tiles_derived', self.derived)
+        stats.count('tiles_missing', len(self._tiles) - len(valid_tiles))
+        if self.derived > derived:
+            sys.stderr.write("Warning: %d tiles could not be downloaded and were made of "
+                             "cached tiles of other zoom levels\n" % (self.derived - derived))
+        missing = len(self._tiles) - len(valid_tiles)
+        if missing:
+            # missing tiles are left blank rather than failing the export
+            sys.stderr.write("Warning: %d of %d tiles are missing\n" % (missing, len(self._tiles)))
+            if len(valid_tiles) == 0:
+                return None
+
+        return valid_tiles
+
+    def _downloaded(self, key, result):
+        """Validates downloaded tile straight from the response, called
+           from download thread."""
+        tile_url = self._tile_urls[key]
+        data = None
+        if result is not None:
+            # failed download is reported by the downloader
+            content_type, data = result
+            if not is_valid_tile(content_type, data):
+                sys.stderr.write("%s is not a complete PNG image\n" % tile_url)
+                data = None
+        if key in self._leased:
+            # saved right away for renderers waiting for the lease
+            if data is not None:
+                self._cache.put(self._source, key[0], key[1], key[2], data)
+            self._cache.leases.release(self._source, *key)
+        elif data is not None:
+            with self._lock:
+                self._new_tiles.append(key + (data,))
+        if data is not None:
+            self._add_tile(key, data)
+
+    def _add_tile(self, key, data):
+        if self._callback is not None:
+            (tx, ty, tz) = key
+            self._callback(tx, ty, tz, data)
+        with self._lock:
+            self._tile_data[key] = data
+
+    def tile_url(self, url, tx, ty, tz):
+        """Returns url of TMS tile, url has {x}, {y} and {z} placeholders
+           in indexing of the tile source."""
+        cx, cy, cz = self._convert_tile(tx, ty, tz)
+        return url.replace('{x}', str(cx)).replace('{y}', str(cy)).replace('{z}', str(cz))
+
+    def tile_urls(self, mirrors, tx, ty, tz):
+        """Returns urls of TMS tile on every mirror of MirrorSet."""
+        return [self.tile_url(template, tx, ty, tz) for template in mirrors.templates]
+
+    def tile_range(self, cache=None, source=None, url=None, ttl=None):
+        """Returns (tminx, tminy, tmaxx, tmaxy, tz) of tiles covering
+           bounding box, or None. Given the arguments of start(), a zoom
+           level with tiles in cache or offline source is preferred."""
+        if self.tile_info is None:
+            self._set_source(cache, source, url, ttl)
+        return self._find_tiles()
+
+    def tile_range_at(self, tz):
+        """Returns (tminx, tminy, tmaxx, tmaxy, tz) of tiles intersecting
+           bounding box at zoom level tz, regardless of width and budget."""
+        ranges = self._tile_ranges(numpy.array([tz]))
+        (tminx, tminy, tmaxx, tmaxy) = [int(r[0]) for r in ranges[:4]]
+        return (tminx, tminy, tmaxx, tmaxy, tz)
 
     def _get_tile_list(self):
-        """Returns list of tiles needed to cover bounding box."""
+        """Returns list of tiles needed to cover bounding box, ordered
+           from the centre outwards."""
         tiles = []
         tile_info = self._find_tiles()
         if tile_info is not None:
             (tminx, tminy, tmaxx, tmaxy, tz) = tile_info
-            for ty in range(tminy, tmaxy + 1):
-                for tx in range(tminx, tmaxx + 1):
-                    tiles.append((tx, ty, tz))
+            tys, txs = numpy.mgrid[tminy:tmaxy + 1, tminx:tmaxx + 1]
+            txs = txs.ravel()
+            tys = tys.ravel()
+            distance = (txs - (tminx + tmaxx) / 2) ** 2 + (tys - (tminy + tmaxy) / 2) ** 2
+            order = numpy.argsort(distance, kind='mergesort')
+            for tx, ty in zip(txs[order].tolist(), tys[order].tolist()):
+                tiles.append((tx, ty, tz))
         return tiles
 
     def _find_tiles(self):
-        """Returns optimal zoom level based on given width."""
-        for zoom_level in range(1, self.max_zoom + 1):
-            tminx, tminy = self._lat_lon_to_tile(self.min_lat, self.min_lon, zoom_level)
-            tmaxx, tmaxy = self._lat_lon_to_tile(self.max_lat, self.max_lon, zoom_level)
-            x_tiles = tmaxx + 1 - tminx
-            if x_tiles > self.x_tiles_needed or zoom_level == self.max_zoom:
-                # optimal zoom level found
-                return (tminx, tminy, tmaxx, tmaxy, zoom_level)
-        return None
+        """Returns (tminx, tminy, tmaxx, tmaxy, tz) of tiles intersecting
+           bounding box at the zoom level whose resolution is nearest to
+           width pixels, lowered until tiles fit in budget."""
+        if self.tile_info is not None or self.max_zoom < 1:
+            return self.tile_info
+        # pixels and tile ranges of every zoom level at once
+        zoom_levels = numpy.arange(1, self.max_zoom + 1)
+        (tminx, tminy, tmaxx, tmaxy,
+         min_px, min_py, max_px, max_py) = self._tile_ranges(zoom_levels)
+        tile_counts = (tmaxx - tminx + 1) * (tmaxy - tminy + 1)
 
-    def _lat_lon_to_tile(self, lat, lon, zoom_level):
-        """Converts given latLon to tile XY"""
-        mx, my = self.mercator.LatLonToMeters(lat, lon)
-        tx, ty = self.mercator.MetersToTile(mx, my, zoom_level)
-        return (tx, ty)
+        # pixels double on every zoom level, pick the nearest one
+        width_px = max_px - min_px
+        i = int(numpy.argmin(numpy.abs(numpy.log2(width_px / max(self.width, 1)))))
+        while i > 0 and not self._fits_budget(tile_counts[i]):
+            i -= 1
+        range_at = lambda j: (int(tminx[j]), int(tminy[j]), int(tmaxx[j]), int(tmaxy[j]),
+                              int(zoom_levels[j]))
+        if self._cache is not None or self._store is not None:
+            i = self._prefer_cached(i, range_at, tile_counts)
 
-    def _gen_tile_file(self, tx, ty, tz, cache_dir):
-        """Returns filename where tile will be saved as."""
-        filename = "%d_%d_%d.%s" % (tx, ty, tz, self.TILE_FORMAT)
-        return os.path.join(cache_dir, filename)
+        fetched_area = tile_counts[i] * self.TILE_WIDTH ** 2
+        visible_area = max(width_px[i] * (max_py[i] - min_py[i]), 1)
+        self.overfetch = fetched_area / visible_area
+        self.tile_info = range_at(i)
+        return self.tile_info
+
+    def _prefer_cached(self, i, range_at, tile_counts):
+        """Returns index of zoom level to use instead of level i when most
+           tiles of level i are missing from cache and a neighbour level is
+           all there. range_at(j) returns tile range of level j."""
+        if self._count_cached(range_at(i)) >= tile_counts[i] * MIN_CACHED:
+            return i
+        if (i + 1 < len(tile_counts) and
+                self._count_cached(range_at(i + 1), True) == tile_counts[i + 1]):
+            # tiles of level i are made of the children
+            if self.derive.children:
+                return i
+            if self._fits_budget(tile_counts[i + 1]):
+                return i + 1
+        if (i > 0 and self.derive.max_upscale >= 2 and
+                self._count_cached(range_at(i - 1), True) == tile_counts[i - 1]):
+            return i - 1
+        return i
+
+    def _count_cached(self, tile_range, stop_at_missing=False):
+        """Returns number of tiles of tile_range found in cache."""
+        (tminx, tminy, tmaxx, tmaxy, tz) = tile_range
+        count = 0
+        for ty in range(tminy, tmaxy + 1):
+            for tx in range(tminx, tmaxx + 1):
+                if self._has_cached(tx, ty, tz, self._ttl):
+                    count += 1
+                elif stop_at_missing:
+                    return count
+        return count
+
+    def _tile_ranges(self, zoom_levels):
+        """Returns arrays of tile ranges (tminx, tminy, tmaxx, tmaxy)
+           and pixels of bounding box (min_px, min_py, max_px, max_py)
+           at given zoom levels."""
+        min_mx, min_my = self.mercator.LatLonToMetersArray(self.min_lat, self.min_lon)
+        max_mx, max_my = self.mercator.LatLonToMetersArray(self.max_lat, self.max_lon)
+        min_px, min_py = self.mercator.MetersToPixelsArray(min_mx, min_my, zoom_levels)
+        max_px, max_py = self.mercator.MetersToPixelsArray(max_mx, max_my, zoom_levels)
+        last_tile = 2 ** zoom_levels - 1
+        tminx = numpy.clip(numpy.floor(min_px / self.TILE_WIDTH), 0, last_tile)
+        tminy = numpy.clip(numpy.floor(min_py / self.TILE_WIDTH), 0, last_tile)
+        tmaxx = numpy.clip(numpy.ceil(max_px / self.TILE_WIDTH) - 1, tminx, last_tile)
+        tmaxy = numpy.clip(numpy.ceil(max_py / self.TILE_WIDTH) - 1, tminy, last_tile)
+        return (tminx, tminy, tmaxx, tmaxy, min_px, min_py, max_px, max_py)
+
+    def _fits_budget(self, tile_count):
+        if self.max_tiles is not None and tile_count > self.max_tiles:
+            return False
+        if self.max_bytes is not None and tile_count * ESTIMATED_TILE_BYTES > self.max_bytes:
+            return False
+        return True
+
+def is_valid_tile(content_type, data):
+    """Checks content type, if server gave it, and that downloaded tile
+       is a complete PNG file, before it is cached."""
+    if content_type is not None and not content_type.startswith('image/'):
+        return False
+    return data.startswith(PNG_MAGIC) and is_complete_png(data)
+
+def is_complete_png(data):
+    """Checks that PNG data has all chunks with correct checksums up to
+       the IEND chunk, so that truncated tiles are caught without decoding
+       them."""
+    pos = len(PNG_MAGIC)
+    while pos + 12 <= len(data):
+        (length, chunk_type) = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + 12 + length
+        if end > len(data):
+            return False
+        (crc,) = struct.unpack('>I', data[end - 4:end])
+        if zlib.crc32(data[pos + 4:end - 4]) & 0xffffffff != crc:
+            return False
+        if chunk_type == 'IEND':
+            return True
+        pos = end
+    return False
 
 class TMSTileLoader(TileLoader):
     def _convert_tile(self, tx, ty, tz):
@@ -117,3 +469,10 @@ class FTileLoader(TileLoader):
         fy = ty - 2**(tz - 1)
         fz = 18 - tz
         return fx, fy, fz
+
+# tile loader classes by indexing of tile source in tiles.json
+TILE_LOADERS = {
+    'google': GoogleTileLoader,
+    'tms':    TMSTileLoader,
+    'f':      FTileLoader,
+}
@@ -154,6 +154,7 @@ $archive_id = (isset($_GET['a'])) ? "'" . $_GET['a'] . "'" : 'null';
                 <select name="format">
                   <option value="pdf">PDF</option>
                   <option value="svg">SVG</option>
+                  <option value="png">PNG</option>
                 </select>
               </td>
             </tr>
@@ -79,7 +79,12 @@ toe.map = {
       return function(coord, zoom) {
         // convert tile indexing
         var converted = toe.map.tileIndexing[tileSource.indexing](coord.x, coord.y, zoom);
-        var url = tileSource.url;
+        // spread tiles over mirrors and subdomains, same tile from same url
+        var i = Math.abs(coord.x + coord.y);
+        var urls = [].concat(tileSource.url);
+        var subdomains = tileSource.subdomains || 'abc';
+        var url = urls[i % urls.length];
+        url = url.replace('{s}', subdomains[i % subdomains.length]);
         url = url.replace('{x}', converted.x);
         url = url.replace('{y}', converted.y);
         url = url.replace('{z}', converted.z);